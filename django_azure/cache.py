@@ -0,0 +1,293 @@
+import errno
+import hashlib
+import mmap
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.core.files.base import File
+try:
+    from django.core.cache import caches
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    get_cache = caches.__getitem__
+
+
+class BasePropertiesCache(object):
+    """
+    Keeps blob properties (the headers of a HEAD request) around so that
+    exists, size and modified_time don't need a round trip each.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    def _count(self, found):
+        with self._counter_lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, container, name):
+        properties = self._get(container, name)
+        self._count(properties is not None)
+        return properties
+
+    def set(self, container, name, properties):
+        self.set_many(container, {name: properties})
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LocalPropertiesCache(BasePropertiesCache):
+    """
+    An in-process LRU cache whose entries expire after ``timeout`` seconds.
+    """
+    def __init__(self, timeout, max_entries):
+        super(LocalPropertiesCache, self).__init__(timeout)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, container, name):
+        key = (container, name)
+        with self._lock:
+            try:
+                expires, properties = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self._entries[key] = (expires, properties)
+            return properties
+
+    def set_many(self, container, properties):
+        expires = time.time() + self.timeout
+        with self._lock:
+            for name, value in properties.items():
+                self._entries.pop((container, name), None)
+                self._entries[(container, name)] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, container, name):
+        with self._lock:
+            self._entries.pop((container, name), None)
+
+
+class DjangoPropertiesCache(BasePropertiesCache):
+    """
+    Stores blob properties in one of the configured Django caches, so
+    they can be shared between processes.
+    """
+    def __init__(self, alias, timeout):
+        super(DjangoPropertiesCache, self).__init__(timeout)
+        self.cache = get_cache(alias)
+
+    def _key(self, container, name):
+        return 'django_azure:properties:%s:%s' % (
+            container, hashlib.md5(name.encode('utf8')).hexdigest())
+
+    def _get(self, container, name):
+        return self.cache.get(self._key(container, name))
+
+    def set_many(self, container, properties):
+        self.cache.set_many(dict((self._key(container, name), value)
+                                 for name, value in properties.items()),
+                            self.timeout)
+
+    def delete(self, container, name):
+        self.cache.delete(self._key(container, name))
+
+
+class CachedFile(File):
+    """
+    A blob read from the disk cache, usually through a memory map
+    """
+    def __init__(self, file, name, size):
+        super(CachedFile, self).__init__(file, name)
+        self.size = size
+        self.mode = 'rb'
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def read(self, size=-1):
+        # mmap.read() requires a size on Python 2
+        if size is None or size < 0:
+            size = max(self.size - self.file.tell(), 0)
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+        self._closed = True
+
+
+class DiskCache(object):
+    """
+    Keeps downloaded blobs in ``directory``, one file per blob named after
+    its container, name and ETag, and removes the least recently used ones
+    when the files known to this process take more than ``max_size``
+    bytes. Files written by other processes are only accounted for when
+    the directory is next scanned, in a new process.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._entries = None
+        self._total = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _key(self, container, name):
+        return hashlib.md5(u'{0}/{1}'.format(container, name)
+                           .encode('utf8')).hexdigest()
+
+    def _filename(self, container, name, etag):
+        return '%s-%s' % (self._key(container, name),
+                          hashlib.md5(etag.encode('utf8')).hexdigest())
+
+    def _load(self):
+        """
+        Indexes the files already in the directory, oldest first
+        """
+        if self._entries is not None:
+            return
+        files = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, filename, stat.st_size))
+        self._entries = OrderedDict()
+        self._total = 0
+        for mtime, filename, size in sorted(files):
+            self._add(filename, size)
+
+    def _add(self, filename, size):
+        key = filename.split('-', 1)[0]
+        if key in self._entries:
+            if self._entries[key][0] == filename:
+                self._total -= self._entries.pop(key)[1]
+            else:
+                # an older version of the blob
+                self._discard(key)
+        self._entries[key] = (filename, size)
+        self._total += size
+
+    def _discard(self, key):
+        filename, size = self._entries.pop(key, (None, 0))
+        if filename is not None:
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def open(self, container, name, etag):
+        """
+        Returns a read-only File of the cached copy of the blob, or None
+        """
+        filename = self._filename(container, name, etag)
+        key = filename.split('-', 1)[0]
+        path = os.path.join(self.directory, filename)
+        with self._lock:
+            self._load()
+            try:
+                local_file = open(path, 'rb')
+            except IOError:
+                return None
+            os.utime(path, None)
+            if key in self._entries and self._entries[key][0] == filename:
+                self._entries[key] = self._entries.pop(key)
+            else:
+                self._add(filename, os.fstat(local_file.fileno()).st_size)
+        size = os.fstat(local_file.fileno()).st_size
+        if size:
+            try:
+                mapped = mmap.mmap(local_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                pass
+            else:
+                local_file.close()
+                local_file = mapped
+        return CachedFile(local_file, name, size)
+
+    def put(self, container, name, etag, chunks):
+        """
+        Stores the blob, given as an iterable of chunks, under its ETag
+        """
+        filename = self._filename(container, name, etag)
+        path = os.path.join(self.directory, filename)
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'wb') as local_file:
+                for chunk in chunks:
+                    local_file.write(chunk)
+                size = local_file.tell()
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self._lock:
+            self._load()
+            self._add(filename, size)
+            while self._total > self.max_size and len(self._entries) > 1:
+                self._discard(next(iter(self._entries)))
+
+    def delete(self, container, name):
+        with self._lock:
+            self._load()
+            self._discard(self._key(container, name))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_properties_cache(backend, timeout, max_entries):
+    """
+    Returns the properties cache for the given backend, which is either
+    'local' or the alias of a Django cache. Storages configured alike
+    share the same cache, so writes through one invalidate the others.
+    """
+    if not backend:
+        return None
+    key = (backend, timeout, max_entries)
+    with _caches_lock:
+        if key not in _caches:
+            if backend == 'local':
+                _caches[key] = LocalPropertiesCache(timeout, max_entries)
+            else:
+                _caches[key] = DjangoPropertiesCache(backend, timeout)
+        return _caches[key]
+
+
+def get_disk_cache(directory, max_size):
+    """
+    Returns the disk cache kept in the given directory, if any
+    """
+    if not directory:
+        return None
+    key = (directory, max_size)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DiskCache(directory, max_size)
+        return _caches[key]
@@ -0,0 +1,87 @@
+import os
+import threading
+from azure import BLOB_SERVICE_HOST_BASE
+from azure.storage.blobservice import BlobService
+from . import settings as ls
+from .retry import RetryPolicy, get_circuit_breaker
+try:
+    from django.utils.module_loading import import_string
+except ImportError:  # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_sessions = {}
+_local = threading.local()
+
+
+def _check_fork():
+    """
+    Drops every pooled connection inherited from a parent process, so that
+    prefork workers never share sockets.
+    """
+    global _pid, _local
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _sessions.clear()
+                _local = threading.local()
+                _pid = os.getpid()
+
+
+def _get_session(key):
+    """
+    Returns the process-wide HTTP session for the given account, which
+    keeps up to AZURE_CONNECTION_POOL_SIZE connections alive.
+    """
+    if requests is None:
+        return None
+    with _lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=ls.AZURE_CONNECTION_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def get_blob_service(account_name, account_key, protocol='https',
+                     host_base=BLOB_SERVICE_HOST_BASE):
+    """
+    Returns a BlobService for the current thread. The SDK client keeps
+    per-request state, so it is never shared between threads, but all
+    clients of an account share one pool of keep-alive connections
+    (when requests is installed).
+    """
+    _check_fork()
+    key = (account_name, account_key, protocol, host_base)
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    if key not in services:
+        service_class = BlobService
+        if ls.AZURE_BLOB_SERVICE:
+            service_class = import_string(ls.AZURE_BLOB_SERVICE)
+        service = service_class(account_name, account_key, protocol,
+                                host_base)
+        if hasattr(service, '_filter'):
+            # like with_filter, without building a second client
+            policy = RetryPolicy(get_circuit_breaker(key), service._httpclient)
+            next_filter = service._filter
+            service._filter = lambda request: policy(request, next_filter)
+        session = None
+        if hasattr(service, '_httpclient'):
+            session = _get_session(key)
+        if session is not None:
+            service._httpclient.request_session = session
+            service._httpclient.use_httplib = True
+        services[key] = service
+    return services[key]
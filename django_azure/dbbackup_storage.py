@@ -1,14 +1,67 @@
+import atexit
+import calendar
+import json
 import re
 import os
+import threading
+import time
+from collections import deque
 from tempfile import SpooledTemporaryFile
 from django.conf import settings
-from azure.storage.blobservice import BlobService
+from azure import WindowsAzureConflictError, WindowsAzureMissingResourceError
+from .client import get_blob_service
+from .utils import BoundedPool, put_blocks
 try:
     from dbbackup.storage.base import BaseStorage, StorageError
 except:
     pass
 
 
+class PipeReader(object):
+    """
+    The read end of a pipe fed by a background download of ``size`` bytes.
+    Seeks are only recorded, so that the size can be found with seek(0, 2)
+    and tell() like dbrestore does, but reading is only possible from the
+    position reached by the download.
+    """
+    def __init__(self, name, fileobj, size):
+        self.name = name
+        self.file = fileobj
+        self.size = size
+        self.error = None
+        self.position = 0
+        self.offset = 0
+
+    def read(self, size=-1):
+        if self.offset != self.position:
+            raise IOError('Cannot seek in a streamed backup')
+        data = self.file.read(size)
+        if not data and self.error is not None:
+            raise StorageError('Download of %s failed: %s' % (self.name,
+                                                              self.error))
+        self.position += len(data)
+        self.offset = self.position
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('Negative seek position %d' % offset)
+        self.offset = offset
+
+    def close(self):
+        self.file.close()
+
+
 class Storage(BaseStorage):
     """
     Azure Storage for django-dbbackup. In settings:
@@ -20,11 +73,21 @@ class Storage(BaseStorage):
     AZURE_DOMAIN = getattr(settings, 'DBBACKUP_AZURE_DOMAIN', '.blob.core.windows.net')
     AZURE_PROTOCOL = getattr(settings, 'DBBACKUP_AZURE_PROTOCOL', 'https')
     AZURE_DIRECTORY = getattr(settings, 'DBBACKUP_AZURE_DIRECTORY', 'django-dbbackups')
+    AZURE_BLOCK_SIZE = getattr(settings, 'DBBACKUP_AZURE_BLOCK_SIZE', 4 * 1024 * 1024)
+    AZURE_CONCURRENCY = getattr(settings, 'DBBACKUP_AZURE_CONCURRENCY', 4)
+    # hand restores a pipe that is filled while they read from it, instead
+    # of a file holding the whole backup
+    AZURE_STREAM_READS = getattr(settings, 'DBBACKUP_AZURE_STREAM_READS', False)
+    # blob in AZURE_DIRECTORY listing the name, size and time of every backup
+    AZURE_INDEX_NAME = getattr(settings, 'DBBACKUP_AZURE_INDEX_NAME', '.index.json')
 
     def __init__(self, server_name=None):
         self._check_errors()
         self.name = 'Microsoft Azure'
-        self._service = None
+        self._index_lock = threading.Lock()
+        self._deletes = []
+        self._delete_pool = None
+        self._flush_registered = False
         BaseStorage.__init__(self)
 
     def _check_errors(self):
@@ -43,33 +106,246 @@ class Storage(BaseStorage):
 
     @property
     def service(self):
-        if self._service is None:
-            self._service = BlobService(self.AZURE_ACCOUNT_NAME,
-                    self.AZURE_ACCOUNT_KEY, self.AZURE_PROTOCOL,
-                    self.AZURE_DOMAIN)
-        return self._service
+        return get_blob_service(self.AZURE_ACCOUNT_NAME,
+                self.AZURE_ACCOUNT_KEY, self.AZURE_PROTOCOL,
+                self.AZURE_DOMAIN)
 
     def backup_dir(self):
         return self.AZURE_DIRECTORY
 
+    @property
+    def index_path(self):
+        return os.path.join(self.AZURE_DIRECTORY, self.AZURE_INDEX_NAME)
+
+    def _load_index(self):
+        try:
+            data = self.service.get_blob(self.AZURE_CONTAINER, self.index_path)
+            return json.loads(data.decode('utf8'))['backups']
+        except (WindowsAzureMissingResourceError, ValueError, KeyError):
+            return None
+
+    def _save_index(self, backups, lease_id=None):
+        data = json.dumps({'version': 1, 'backups': backups})
+        self.service.put_blob(self.AZURE_CONTAINER, self.index_path,
+                              data.encode('utf8'), 'BlockBlob',
+                              x_ms_blob_content_type='application/json',
+                              x_ms_lease_id=lease_id)
+
+    def _lease_index(self):
+        """
+        Acquires a lease on the index blob, waiting for up to a minute
+        while another process holds it
+        """
+        deadline = time.time() + 60
+        while True:
+            try:
+                return self.service.lease_blob(
+                    self.AZURE_CONTAINER, self.index_path, 'acquire',
+                    x_ms_lease_duration=15)['x-ms-lease-id']
+            except WindowsAzureConflictError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def rebuild_index(self):
+        """
+        Rebuilds the index from a full listing of AZURE_DIRECTORY
+        """
+        backups, marker = {}, None
+        while True:
+            blobs = self.service.list_blobs(
+                self.AZURE_CONTAINER, prefix=self.AZURE_DIRECTORY + '/',
+                marker=marker)
+            for blob in blobs:
+                name = re.sub(r'^%s/' % self.AZURE_DIRECTORY, '', blob.name)
+                if name == self.AZURE_INDEX_NAME:
+                    continue
+                backups[name] = {
+                    'size': int(blob.properties.content_length),
+                    'modified': calendar.timegm(time.strptime(
+                        blob.properties.last_modified,
+                        '%a, %d %b %Y %H:%M:%S GMT'))}
+            marker = blobs.next_marker
+            if not marker:
+                break
+        self._save_index(backups)
+        return backups
+
+    def get_index(self):
+        """
+        Returns a dict of backup name to its size and modification time
+        """
+        if self._deletes:
+            return self._update_index()
+        backups = self._load_index()
+        if backups is None:
+            backups = self.rebuild_index()
+        return backups
+
+    def _wait_for_deletes(self):
+        """
+        Waits for the deletes queued by delete_file. Returns the backups
+        deleted and the first error met, if any.
+        """
+        with self._index_lock:
+            deletes, self._deletes = self._deletes, []
+        deleted, error = set(), None
+        for filepath, result in deletes:
+            try:
+                result.get()
+            except Exception as e:
+                error = error or e
+            else:
+                deleted.add(filepath)
+        return deleted, error
+
+    def _update_index(self, added=None, removed=()):
+        """
+        Applies changes to the index, along with the removals deferred by
+        delete_file once their deletes are done. The index blob is leased
+        meanwhile, so that backups and cleanups running in other processes
+        don't lose each other's updates. Raises the first error met by a
+        queued delete, after the update. Returns the updated index.
+        """
+        deleted, error = self._wait_for_deletes()
+        with self._index_lock:
+            removed = set(removed) | deleted
+            if self._load_index() is None:
+                self.rebuild_index()
+            lease_id = self._lease_index()
+            try:
+                backups = self._load_index() or {}
+                backups.update(added or {})
+                for name in removed:
+                    backups.pop(name, None)
+                self._save_index(backups, lease_id)
+            finally:
+                self.service.lease_blob(self.AZURE_CONTAINER,
+                                        self.index_path, 'release',
+                                        x_ms_lease_id=lease_id)
+        if error is not None:
+            raise error
+        return backups
+
+    def flush_index(self):
+        """
+        Waits for the deletes queued by delete_file and removes the backups
+        deleted from the index
+        """
+        if self._deletes:
+            self._update_index()
+
+    def _delete_blob(self, filepath):
+        try:
+            self.service.delete_blob(
+                self.AZURE_CONTAINER,
+                os.path.join(self.AZURE_DIRECTORY, filepath))
+        except WindowsAzureMissingResourceError:
+            pass
+
     def delete_file(self, filepath):
-        filepath = os.path.join(self.AZURE_DIRECTORY, filepath)
-        self.service.delete_blob(self.AZURE_CONTAINER, filepath)
+        """
+        Queues the delete of a backup, which may already be gone, so that
+        the deletes of a cleanup run AZURE_CONCURRENCY at a time. They are
+        waited for, and the backups removed from the index in a single
+        update, when the index is next read or updated, or the process
+        exits.
+        """
+        with self._index_lock:
+            if self._delete_pool is None:
+                self._delete_pool = BoundedPool(self.AZURE_CONCURRENCY)
+            pool = self._delete_pool
+            if not self._flush_registered:
+                atexit.register(self.flush_index)
+                self._flush_registered = True
+        # blocks while AZURE_CONCURRENCY deletes are in flight
+        result = pool.submit(self._delete_blob, filepath)
+        with self._index_lock:
+            self._deletes.append((filepath, result))
+
+    def delete_files(self, filepaths):
+        """
+        Deletes many backups concurrently, with a single index update
+        """
+        for filepath in filepaths:
+            self.delete_file(filepath)
+        self.flush_index()
+
+    def delete_expired(self, max_age):
+        """
+        Deletes the backups older than max_age seconds and returns their
+        names
+        """
+        limit = time.time() - max_age
+        expired = [name for name, backup in self.get_index().items()
+                   if backup['modified'] < limit]
+        self.delete_files(expired)
+        return expired
 
     def list_directory(self):
-        return [re.sub(r'^%s/' % self.AZURE_DIRECTORY, '', blob.name) \
-                for blob in self.service.list_blobs(
-                self.AZURE_CONTAINER, prefix=self.AZURE_DIRECTORY)]
+        return sorted(self.get_index())
 
     def write_file(self, filehandle):
         filepath = os.path.join(self.AZURE_DIRECTORY, filehandle.name)
         filehandle.seek(0)
-        self.service.put_block_blob_from_file(self.AZURE_CONTAINER,
-                                              filepath, filehandle)
+        blocks = iter(lambda: filehandle.read(self.AZURE_BLOCK_SIZE), b'')
+        put_blocks(lambda: self.service, self.AZURE_CONTAINER, filepath,
+                   blocks, self.AZURE_CONCURRENCY)
+        self._update_index(added={filehandle.name: {
+            'size': filehandle.tell(), 'modified': time.time()}})
+
+    def _get_range(self, filepath, start, end):
+        return self.service.get_blob(self.AZURE_CONTAINER, filepath,
+                                     x_ms_range='bytes=%d-%d' % (start, end))
+
+    def _blob_size(self, filepath):
+        return int(self.service.get_blob_properties(
+            self.AZURE_CONTAINER, filepath)['content-length'])
+
+    def _download(self, filepath, write, size=None):
+        """
+        Downloads a blob in ranges fetched concurrently, and hands them to
+        write in order
+        """
+        if size is None:
+            size = self._blob_size(filepath)
+        with BoundedPool(self.AZURE_CONCURRENCY) as pool:
+            pending = deque()
+            for start in range(0, size, self.AZURE_BLOCK_SIZE):
+                if len(pending) >= self.AZURE_CONCURRENCY:
+                    write(pending.popleft().get())
+                end = min(start + self.AZURE_BLOCK_SIZE, size) - 1
+                pending.append(pool.submit(self._get_range, filepath,
+                                           start, end))
+            while pending:
+                write(pending.popleft().get())
 
     def read_file(self, filepath):
         filepath = os.path.join(self.AZURE_DIRECTORY, filepath)
+        # gzip and gpg seek back and forth in their input
+        if self.AZURE_STREAM_READS and \
+                not filepath.endswith(('.gz', '.gpg')):
+            return self._stream_file(filepath)
         filehandle = SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        self.service.get_blob_to_file(self.AZURE_CONTAINER, filepath,
-                                      filehandle)
+        self._download(filepath, filehandle.write)
+        filehandle.seek(0)
         return filehandle
+
+    def _stream_file(self, filepath):
+        size = self._blob_size(filepath)
+        read_fd, write_fd = os.pipe()
+        reader = PipeReader(filepath, os.fdopen(read_fd, 'rb'), size)
+        writer = os.fdopen(write_fd, 'wb')
+
+        def pump():
+            try:
+                self._download(filepath, writer.write, size)
+            except Exception as e:
+                reader.error = e
+            finally:
+                writer.close()
+
+        thread = threading.Thread(target=pump)
+        thread.daemon = True
+        thread.start()
+        return reader
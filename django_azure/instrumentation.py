@@ -0,0 +1,184 @@
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.dispatch import Signal
+from . import settings as ls
+try:
+    from django.utils.module_loading import import_string
+except ImportError:  # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # Django < 1.10
+    MiddlewareMixin = object
+
+
+logger = logging.getLogger('django_azure')
+
+# sent after every storage operation, with the storage as sender
+storage_operation = Signal(providing_args=['storage', 'operation', 'name',
+                                           'duration', 'size', 'error'])
+
+_local = threading.local()
+_collector = None
+_collector_lock = threading.Lock()
+
+
+class BaseCollector(object):
+    """
+    Receives every storage operation. Subclass it to feed statsd,
+    Prometheus or any other metrics system, and point
+    AZURE_METRICS_COLLECTOR to the subclass.
+    """
+    def record(self, operation, duration, size, error):
+        raise NotImplementedError
+
+
+class StatsdCollector(BaseCollector):
+    """
+    Sends timings, outcomes and transferred bytes to a statsd client with
+    timing(name, ms) and incr(name, count) methods, like the one of the
+    statsd package.
+    """
+    def __init__(self, client=None, prefix='django_azure'):
+        if client is None:
+            import statsd
+            client = statsd.StatsClient()
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, operation, duration, size, error):
+        key = '%s.%s' % (self.prefix, operation)
+        self.client.timing(key, duration * 1000)
+        self.client.incr('%s.%s' % (key, 'error' if error else 'ok'))
+        if size:
+            self.client.incr('%s.bytes' % key, size)
+
+
+class CountingCollector(BaseCollector):
+    """
+    Keeps Prometheus-style cumulative counters per operation in process,
+    for an exporter or a status view to read with samples().
+    """
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, operation, duration, size, error):
+        with self._lock:
+            self.calls[operation] += 1
+            self.seconds[operation] += duration
+            self.bytes[operation] += size or 0
+            if error:
+                self.errors[operation] += 1
+
+    def samples(self):
+        """
+        Returns (metric, operation, value) tuples
+        """
+        with self._lock:
+            return [(metric, operation, value)
+                    for metric, values in (
+                        ('django_azure_calls_total', self.calls),
+                        ('django_azure_errors_total', self.errors),
+                        ('django_azure_seconds_total', self.seconds),
+                        ('django_azure_bytes_total', self.bytes))
+                    for operation, value in sorted(values.items())]
+
+
+def get_collector():
+    global _collector
+    if _collector is None and ls.AZURE_METRICS_COLLECTOR:
+        with _collector_lock:
+            if _collector is None:
+                _collector = import_string(ls.AZURE_METRICS_COLLECTOR)()
+    return _collector
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.duration = 0.0
+
+    def add(self, operation, duration):
+        self.calls[operation] += 1
+        self.duration += duration
+
+    def summary(self):
+        return '%d calls in %.3fs (%s)' % (
+            sum(self.calls.values()), self.duration,
+            ', '.join('%s: %d' % item for item in sorted(self.calls.items())))
+
+
+def record(storage, operation, name, duration, size=0, error=None):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.add(operation, duration)
+    collector = get_collector()
+    if collector is not None:
+        collector.record(operation, duration, size, error)
+    storage_operation.send(sender=type(storage), storage=storage,
+                           operation=operation, name=name, duration=duration,
+                           size=size, error=error)
+
+
+def record_event(operation, duration=0, error=None):
+    """
+    Reports something happening below the storage API, like a retried
+    request, to the request stats and the collector
+    """
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        # its time is already part of the storage operation
+        stats.add(operation, 0)
+    collector = get_collector()
+    if collector is not None:
+        collector.record(operation, duration, 0, error)
+
+
+def instrumented(operation, measure=None):
+    """
+    Decorates a storage method taking the blob name first, so that every
+    call is recorded. measure(args, result) returns the bytes transferred.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, name, *args, **kwargs):
+            started = time.time()
+            try:
+                result = method(self, name, *args, **kwargs)
+            except Exception as e:
+                record(self, operation, name, time.time() - started, error=e)
+                raise
+            record(self, operation, name, time.time() - started,
+                   size=measure(args, result) if measure else 0)
+            return result
+        return wrapper
+    return decorator
+
+
+class StorageStatsMiddleware(MiddlewareMixin):
+    """
+    Counts the storage operations made while serving each request and logs
+    a summary to the django_azure logger; with DEBUG it is also sent as
+    the X-Azure-Storage response header. Handy to find templates asking
+    the cloud once per file.
+    """
+    def process_request(self, request):
+        _local.stats = RequestStats()
+
+    def process_response(self, request, response):
+        stats = getattr(_local, 'stats', None)
+        _local.stats = None
+        if stats is not None and stats.calls:
+            logger.debug('%s %s: %s', request.method, request.path,
+                         stats.summary())
+            if settings.DEBUG:
+                response['X-Azure-Storage'] = stats.summary()
+        return response
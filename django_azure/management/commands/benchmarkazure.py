@@ -0,0 +1,282 @@
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from optparse import make_option
+import django
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand, CommandError
+from ... import settings as ls
+from ...storage import AzureStorage
+
+
+SCENARIOS = ('save_small', 'open_small', 'save_large', 'open_large',
+             'save_gzip', 'open_gzip', 'listdir', 'uploadfiles')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Command(NoArgsCommand):
+    """
+    Measures the throughput and latency of the storage against a scratch
+    container, preferably on a local emulator (run it with EMULATED=true
+    and --emulator to use Azurite on 127.0.0.1:10000) or in memory, and
+    writes the results as JSON so that runs can be compared.
+    """
+    option_list = NoArgsCommand.option_list + (
+            make_option('--container', action='store',
+                        default=ls.AZURE_TEST_CONTAINER, dest='container',
+                        help='Scratch container the blobs are written to'),
+            make_option('--emulator', action='store_true',
+                        default=False, dest='emulator',
+                        help='Use the development storage account of a '
+                             'local emulator'),
+            make_option('--memory', action='store_true',
+                        default=False, dest='memory',
+                        help='Keep the blobs in process with '
+                             'MemoryBlobService, as a baseline without '
+                             'network'),
+            make_option('-s', '--scenario', action='append', default=[],
+                        dest='scenarios', metavar='SCENARIO',
+                        help='Scenario to run, one of %s. All of them by '
+                             'default.' % ', '.join(SCENARIOS)),
+            make_option('--small-count', action='store', type='int',
+                        default=200, dest='small_count',
+                        help='Number of small blobs'),
+            make_option('--small-size', action='store', type='int',
+                        default=4 * 1024, dest='small_size',
+                        help='Size of the small blobs in bytes'),
+            make_option('--large-count', action='store', type='int',
+                        default=3, dest='large_count',
+                        help='Number of large blobs'),
+            make_option('--large-size', action='store', type='int',
+                        default=32 * 1024 * 1024, dest='large_size',
+                        help='Size of the large blobs in bytes'),
+            make_option('--list-count', action='store', type='int',
+                        default=100000, dest='list_count',
+                        help='Number of blobs listed by listdir'),
+            make_option('--tree-files', action='store', type='int',
+                        default=500, dest='tree_files',
+                        help='Number of files in the tree given to '
+                             'uploadfiles'),
+            make_option('--parallel', action='store', type='int',
+                        default=8, dest='parallel',
+                        help='Concurrency of uploadfiles'),
+            make_option('--output', action='store', dest='output',
+                        help='File the JSON results are written to, '
+                             'instead of the standard output'),
+            make_option('--keep', action='store_true',
+                        default=False, dest='keep',
+                        help="Don't delete the blobs written"))
+
+    def handle_noargs(self, **options):
+        self.set_options(**options)
+        if self.container is None:
+            raise CommandError('Set AZURE_TEST_CONTAINER or --container')
+        unknown = set(self.scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: %s' %
+                               ', '.join(sorted(unknown)))
+
+        if self.emulator:
+            # without credentials, the SDK talks to the emulator's
+            # development account (uploadfiles included)
+            os.environ['EMULATED'] = 'true'
+            AzureStorage.account_name = AzureStorage.account_key = None
+        if self.memory:
+            ls.AZURE_BLOB_SERVICE = 'django_azure.memory.MemoryBlobService'
+        self.storage = AzureStorage(container=self.container,
+                                    gzipped=False)
+        self.gzip_storage = AzureStorage(container=self.container,
+                                         gzipped=True,
+                                         gzipped_content_types=('text/plain',))
+        self.prefix = u'benchmark-%s/' % uuid.uuid4().hex[:8]
+        self.written = []
+
+        results = []
+        try:
+            for scenario in SCENARIOS:
+                if scenario in self.scenarios:
+                    self.log('running %s...' % scenario)
+                    results.append(getattr(self, 'run_%s' % scenario)())
+        finally:
+            if not self.keep:
+                self.storage.delete_many(self.written)
+
+        report = json.dumps({
+            'version': 1,
+            'date': datetime.utcnow().strftime(ls.TIMESTAMP_FORMAT),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'emulator': self.emulator,
+            'memory': self.memory,
+            'results': results}, indent=2, sort_keys=True)
+        if self.output:
+            with open(self.output, 'w') as output:
+                output.write(report)
+            for result in results:
+                self.log('%(scenario)s: %(operations_per_second).1f ops/s, '
+                         '%(megabytes_per_second).2f MB/s' % result, 1)
+        else:
+            self.stdout.write(report)
+
+    def measure(self, scenario, func, items, size):
+        """
+        Calls func on every item, and returns the throughput and latency
+        figures of the scenario
+        """
+        latencies = []
+        started = time.time()
+        for item in items:
+            start = time.time()
+            func(item)
+            latencies.append(time.time() - start)
+        return self.result(scenario, time.time() - started, latencies,
+                           size * len(latencies))
+
+    def result(self, scenario, elapsed, latencies, transferred):
+        elapsed = max(elapsed, 0.000001)
+        return {
+            'scenario': scenario,
+            'operations': len(latencies),
+            'bytes': transferred,
+            'seconds': elapsed,
+            'operations_per_second': len(latencies) / elapsed,
+            'megabytes_per_second': transferred / elapsed / (1024 * 1024),
+            'latency_ms': {
+                'min': min(latencies) * 1000,
+                'mean': sum(latencies) / len(latencies) * 1000,
+                'p50': percentile(latencies, 0.5) * 1000,
+                'p95': percentile(latencies, 0.95) * 1000,
+                'max': max(latencies) * 1000}}
+
+    def names(self, kind, count):
+        return [u'%s%s/%06d.txt' % (self.prefix, kind, i)
+                for i in range(count)]
+
+    def save(self, storage, name, data):
+        storage.save(name, ContentFile(data))
+        self.written.append(name)
+
+    def read(self, storage, name):
+        with storage.open(name) as blob:
+            for chunk in blob.chunks():
+                pass
+
+    def run_save_small(self):
+        data = os.urandom(self.small_size)
+        return self.measure(
+            'save_small', lambda name: self.save(self.storage, name, data),
+            self.names('small', self.small_count), self.small_size)
+
+    def run_open_small(self):
+        names = self.names('small', self.small_count)
+        if 'save_small' not in self.scenarios:
+            self.run_save_small()
+        return self.measure('open_small',
+                            lambda name: self.read(self.storage, name),
+                            names, self.small_size)
+
+    def run_save_large(self):
+        data = os.urandom(self.large_size)
+        return self.measure(
+            'save_large', lambda name: self.save(self.storage, name, data),
+            self.names('large', self.large_count), self.large_size)
+
+    def run_open_large(self):
+        names = self.names('large', self.large_count)
+        if 'save_large' not in self.scenarios:
+            self.run_save_large()
+        return self.measure('open_large',
+                            lambda name: self.read(self.storage, name),
+                            names, self.large_size)
+
+    def gzip_data(self):
+        line = u'The quick brown fox jumps over the lazy dog %d\n'
+        return u''.join(line % i for i in range(self.small_size // 40 + 1)
+                        ).encode('utf8')
+
+    def run_save_gzip(self):
+        data = self.gzip_data()
+        return self.measure(
+            'save_gzip', lambda name: self.save(self.gzip_storage, name, data),
+            self.names('gzip', self.small_count), len(data))
+
+    def run_open_gzip(self):
+        names = self.names('gzip', self.small_count)
+        if 'save_gzip' not in self.scenarios:
+            self.run_save_gzip()
+        # the compressed blob is what gets transferred
+        return self.measure('open_gzip',
+                            lambda name: self.read(self.gzip_storage, name),
+                            names, self.gzip_storage.size(names[0]))
+
+    def run_listdir(self):
+        names = self.names('list', self.list_count)
+        self.log('creating %d blobs to list...' % len(names))
+        self.storage.save_many((name, ContentFile(b'')) for name in names)
+        self.written.extend(names)
+        return self.measure('listdir', self.storage.listdir,
+                            [self.prefix + u'list'], 0)
+
+    def run_uploadfiles(self):
+        source = tempfile.mkdtemp()
+        transferred = 0
+        try:
+            for i in range(self.tree_files):
+                directory = os.path.join(source, 'dir-%02d' % (i % 20))
+                if not os.path.isdir(directory):
+                    os.mkdir(directory)
+                # mostly small files, with a larger one every 50
+                size = self.small_size * (64 if i % 50 == 0 else 1)
+                with open(os.path.join(directory, '%06d.bin' % i), 'wb') as f:
+                    f.write(os.urandom(size))
+                transferred += size
+                self.written.append(u'%stree/dir-%02d/%06d.bin' % (
+                    self.prefix, i % 20, i))
+            started = time.time()
+            with open(os.devnull, 'w') as devnull:
+                call_command('uploadfiles', source=source,
+                             container=self.container,
+                             dir=self.prefix + u'tree',
+                             parallel=self.parallel, verbosity=0,
+                             stdout=devnull)
+            elapsed = time.time() - started
+        finally:
+            shutil.rmtree(source)
+        return self.result('uploadfiles', elapsed, [elapsed], transferred)
+
+    def log(self, msg, level=2):
+        """
+        Small log helper
+        """
+        if self.verbosity >= level:
+            sys.stderr.write(msg + '\n')
+
+    def set_options(self, **options):
+        """
+        Set instance variables based on an options dict
+        """
+        self.container = options['container'] or ls.AZURE_TEST_CONTAINER
+        self.emulator = options['emulator']
+        self.memory = options['memory']
+        self.scenarios = options['scenarios'] or list(SCENARIOS)
+        self.small_count = options['small_count']
+        self.small_size = options['small_size']
+        self.large_count = options['large_count']
+        self.large_size = options['large_size']
+        self.list_count = options['list_count']
+        self.tree_files = options['tree_files']
+        self.parallel = options['parallel']
+        self.output = options['output']
+        self.keep = options['keep']
+        self.verbosity = int(options.get('verbosity', 1))
@@ -0,0 +1,104 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from ... import settings as ls
+from ...storage import AzureStorage
+from ...tiers import COOL, HOT, TIERS, iter_blob_tiers, set_blob_tier
+from ...utils import BoundedPool
+
+
+class Command(NoArgsCommand):
+    """
+    Moves the blobs not modified for some days to a cooler access tier.
+    The container is listed a page at a time while the blobs found are
+    moved concurrently; blobs already as cool or being rehydrated are
+    left alone, as are blobs on premium tiers.
+    """
+    option_list = NoArgsCommand.option_list + (
+            make_option('--container', action='store',
+                        default=ls.AZURE_DEFAULT_CONTAINER, dest='container',
+                        help='Azure container'),
+            make_option('--prefix', action='store', dest='prefix',
+                        help='Only consider blobs whose name starts with '
+                             'this prefix'),
+            make_option('--days', action='store', type='int', dest='days',
+                        help='Move blobs not modified for that many days'),
+            make_option('--tier', action='store', default=COOL,
+                        dest='tier', choices=TIERS[1:],
+                        help='Tier to move the blobs to, Cool (default) '
+                             'or Archive'),
+            make_option('--parallel', action='store', type='int',
+                        default=8, dest='parallel',
+                        help='Number of blobs to move concurrently'),
+            make_option('--dry-run', action='store_true',
+                        default=False, dest='dry_run',
+                        help="Only list the blobs that would be moved"))
+
+    def handle_noargs(self, **options):
+        self.set_options(**options)
+        if self.container is None:
+            raise CommandError('AZURE_DEFAULT_CONTAINER setting is missing')
+        if self.days is None:
+            raise CommandError('Specify --days')
+
+        storage = AzureStorage(container=self.container)
+        cutoff = datetime.utcnow() - timedelta(days=self.days)
+        self.moved = self.skipped = self.failed = 0
+        started = time.time()
+        with BoundedPool(self.parallel) as pool:
+            for name, last_modified, tier, archive_status in iter_blob_tiers(
+                    storage.service, self.container, self.prefix):
+                tier = tier or HOT
+                # premium tiers like P10 are not ours to change
+                if tier not in TIERS or archive_status or \
+                        datetime(*parsedate(last_modified)[:6]) > cutoff or \
+                        TIERS.index(tier) >= TIERS.index(self.tier):
+                    with self.lock:
+                        self.skipped += 1
+                    continue
+                if self.dry_run:
+                    self.log('would move %s (%s) to %s' % (name, tier,
+                                                          self.tier), 1)
+                    continue
+                pool.submit(self.move_blob, storage, name)
+        self.stdout.write('%s blobs moved to %s, %s skipped, %s failed in '
+                          '%.1fs.' % (self.moved, self.tier, self.skipped,
+                                      self.failed, time.time() - started))
+        if self.failed:
+            raise CommandError('%s blobs failed to move' % self.failed)
+
+    def move_blob(self, storage, name):
+        self.log('moving %s to %s...' % (name, self.tier))
+        try:
+            set_blob_tier(storage.service, self.container, name, self.tier)
+        except Exception as e:
+            self.log('moving %s failed: %s' % (name, e), 1)
+            with self.lock:
+                self.failed += 1
+        else:
+            with self.lock:
+                self.moved += 1
+
+    def log(self, msg, level=2):
+        """
+        Small log helper
+        """
+        if self.verbosity >= level:
+            with self.lock:
+                self.stdout.write(msg)
+
+    def set_options(self, **options):
+        """
+        Set instance variables based on an options dict
+        """
+        self.container = options['container'] or ls.AZURE_DEFAULT_CONTAINER
+        self.prefix = options['prefix']
+        self.days = options['days']
+        self.tier = options['tier']
+        self.parallel = options['parallel']
+        self.dry_run = options['dry_run']
+        self.verbosity = int(options.get('verbosity', 1))
+        self.lock = threading.Lock()
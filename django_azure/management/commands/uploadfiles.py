@@ -1,10 +1,16 @@
+import base64
+import hashlib
 import os
+import threading
+import time
 from optparse import make_option
+from azure import WindowsAzureConflictError, WindowsAzureMissingResourceError
 from django.conf import settings
 from django.contrib.staticfiles.utils import matches_patterns
 from django.core.management.base import NoArgsCommand, CommandError
 from ... import settings as ls
-from ...storage import AzureStorage
+from ...storage import AzureStorage, source_md5
+from ...utils import BoundedPool
 
 
 class Command(NoArgsCommand):
@@ -23,7 +29,18 @@ class Command(NoArgsCommand):
                         help="Don't ignore the common private patterns "
                                 "'.*' and '*~'."),
             make_option('--dir', action='store', dest='dir',
-                        help="Directory to upload files in."))
+                        help="Directory to upload files in."),
+            make_option('--parallel', action='store', type='int',
+                        default=1, dest='parallel',
+                        help='Number of files to upload concurrently'),
+            make_option('--sync', action='store_true',
+                        default=False, dest='sync',
+                        help="Skip files whose size and Content-MD5 "
+                             "match the existing blob"),
+            make_option('--retries', action='store', type='int',
+                        default=3, dest='retries',
+                        help='Times to retry a failed upload, with '
+                             'exponential backoff'))
 
     def handle_noargs(self, **options):
         self.set_options(**options)
@@ -40,33 +57,99 @@ class Command(NoArgsCommand):
                  'container "%s"' % (self.source, self.container))
 
         storage = AzureStorage(container=self.container)
-        uploaded_files = []
-        for root, dirs, files in os.walk(self.source): #@UnusedVariable
-            for f in files:
-                if matches_patterns(f, self.ignore_patterns):
-                    continue
-                path = os.path.join(root, f)
-                blob_name = os.path.relpath(path, self.source).replace('\\', '/')
-                if self.dir:
-                    blob_name = os.path.join(self.dir, blob_name)
-                self.log('uploading %s...' % blob_name)
-                try:
-                    with open(path, 'rb') as source_file:
-                        storage.save(blob_name, source_file)
-                except Exception as e:
-                    self.log('upload aborted...')
-                    self.log(str(e), 3)
-                    return
-                else:
-                    uploaded_files.append(blob_name)
-        self.stdout.write('%s files uploaded.' % len(uploaded_files))
+        remote_blobs = self.list_remote_blobs(storage) if self.sync else {}
+        self.uploaded = self.skipped = self.failed = self.bytes = 0
+        started = time.time()
+        with BoundedPool(self.parallel) as pool:
+            for root, dirs, files in os.walk(self.source): #@UnusedVariable
+                for f in files:
+                    if matches_patterns(f, self.ignore_patterns):
+                        continue
+                    path = os.path.join(root, f)
+                    blob_name = os.path.relpath(path, self.source).replace('\\', '/')
+                    if self.dir:
+                        blob_name = os.path.join(self.dir, blob_name)
+                    pool.submit(self.upload_file, storage, path, blob_name,
+                                remote_blobs.get(blob_name))
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write('%s files uploaded, %s skipped, %s failed. '
+                          '%s bytes in %.1fs (%.1f KB/s).' % (
+                              self.uploaded, self.skipped, self.failed,
+                              self.bytes, elapsed, self.bytes / elapsed / 1024))
+        if self.failed:
+            raise CommandError('%s files failed to upload' % self.failed)
+
+    def list_remote_blobs(self, storage):
+        """
+        Returns the size and Content-MD5 of every blob under the target
+        directory. Compressed blobs have no size and the MD5 of the file
+        they were stored from.
+        """
+        return dict((blob.name, (None if blob.properties.content_encoding
+                                 else int(blob.properties.content_length),
+                                 source_md5(blob)))
+                    for blob in storage.iter_blobs(self.dir,
+                                                   include='metadata'))
+
+    def file_md5(self, path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(64 * 1024), b''):
+                md5.update(chunk)
+        return base64.b64encode(md5.digest()).decode('ascii')
+
+    def upload_file(self, storage, path, blob_name, remote_blob):
+        """
+        Uploads a single file, retrying transient failures
+        """
+        try:
+            size = os.path.getsize(path)
+            unchanged = remote_blob is not None and \
+                remote_blob[0] in (None, size) and \
+                remote_blob[1] == self.file_md5(path)
+        except EnvironmentError as e:
+            # broken symlinks, unreadable files
+            self.failed_upload(blob_name, e)
+            return
+        if unchanged:
+            self.log('skipping %s...' % blob_name)
+            with self.lock:
+                self.skipped += 1
+            return
+        self.log('uploading %s...' % blob_name)
+        for attempt in range(self.retries + 1):
+            try:
+                with open(path, 'rb') as source_file:
+                    storage.save(blob_name, source_file)
+            except (WindowsAzureConflictError,
+                    WindowsAzureMissingResourceError) as e:
+                error = e
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    self.log('retrying %s...' % blob_name)
+                    time.sleep(2 ** attempt)
+            else:
+                with self.lock:
+                    self.uploaded += 1
+                    self.bytes += size
+                return
+        self.failed_upload(blob_name, error)
+
+    def failed_upload(self, blob_name, error):
+        self.log('upload of %s failed...' % blob_name, 1)
+        self.log(str(error), 3)
+        with self.lock:
+            self.failed += 1
 
     def log(self, msg, level=2):
         """
         Small log helper
         """
         if self.verbosity >= level:
-            self.stdout.write(msg)
+            with self.lock:
+                self.stdout.write(msg)
 
     def set_options(self, **options):
         """
@@ -80,3 +163,7 @@ class Command(NoArgsCommand):
             ignore_patterns += ['.*', '*~']
         self.ignore_patterns = list(set(ignore_patterns))
         self.dir = options['dir']
+        self.parallel = options['parallel']
+        self.sync = options['sync']
+        self.retries = options['retries']
+        self.lock = threading.Lock()
@@ -0,0 +1,411 @@
+import base64
+import hashlib
+import threading
+import time
+import uuid
+from azure import (BLOB_SERVICE_HOST_BASE, HeaderDict, WindowsAzureError,
+                   WindowsAzureConflictError, WindowsAzureMissingResourceError)
+from azure.storage import Blob, BlobEnumResults, BlobPrefix, BlobResult
+from . import settings as ls
+try:
+    from urllib.parse import unquote, urlparse
+except ImportError:  # Python 2
+    from urllib import unquote
+    from urlparse import urlparse
+
+
+_accounts = {}
+_accounts_lock = threading.Lock()
+
+# put_blob/put_block_list arguments and the properties they set
+_PROPERTY_HEADERS = (
+    ('x_ms_blob_content_type', 'content-type'),
+    ('x_ms_blob_content_encoding', 'content-encoding'),
+    ('x_ms_blob_content_language', 'content-language'),
+    ('x_ms_blob_content_md5', 'content-md5'),
+    ('x_ms_blob_cache_control', 'cache-control'),
+)
+# BlobProperties attributes filled in listings, and their headers
+_LISTED_PROPERTIES = (
+    ('last_modified', 'last-modified'),
+    ('etag', 'etag'),
+    ('content_type', 'content-type'),
+    ('content_encoding', 'content-encoding'),
+    ('content_language', 'content-language'),
+    ('content_md5', 'content-md5'),
+    ('blob_type', 'x-ms-blob-type'),
+)
+
+
+def _to_bytes(data):
+    # like the SDK, which sends text as UTF-8
+    if not data:
+        return b''
+    if not isinstance(data, bytes):
+        return data.encode('utf-8')
+    return data
+
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def _check_md5(data, content_md5):
+    if content_md5 is not None and content_md5 != _md5(data):
+        raise WindowsAzureError('The MD5 value specified in the request '
+                                'did not match with the MD5 value '
+                                'calculated by the server.')
+
+
+class MemoryAccount(object):
+    """
+    The containers of one fake storage account, shared by every
+    MemoryBlobService of that account in the process.
+    """
+    def __init__(self):
+        self.containers = {}
+        self.blocks = {}
+        self.leases = {}
+        self.lock = threading.RLock()
+
+
+def reset():
+    """
+    Forgets every blob of every fake account
+    """
+    with _accounts_lock:
+        _accounts.clear()
+
+
+class MemoryBlobService(object):
+    """
+    An in-process stand-in for the BlobService of the azure SDK, covering
+    the calls this package makes, with the same results and exceptions.
+    Point AZURE_BLOB_SERVICE to it to run tests and local development
+    without an account. Containers are created on first write.
+
+    Every call sleeps for ``latency`` seconds (AZURE_MEMORY_LATENCY) first,
+    to make it behave a bit more like the network in performance tests.
+    """
+    def __init__(self, account_name=None, account_key=None, protocol='https',
+                 host_base=BLOB_SERVICE_HOST_BASE, latency=None):
+        self.account_name = account_name or 'devstoreaccount1'
+        self.account_key = account_key
+        self.protocol = protocol
+        self.host_base = host_base
+        self.latency = ls.AZURE_MEMORY_LATENCY if latency is None else latency
+        with _accounts_lock:
+            if self.account_name not in _accounts:
+                _accounts[self.account_name] = MemoryAccount()
+            self.account = _accounts[self.account_name]
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _container(self, container_name, create=False):
+        if create:
+            return self.account.containers.setdefault(container_name, {})
+        try:
+            return self.account.containers[container_name]
+        except KeyError:
+            raise WindowsAzureMissingResourceError(
+                'The specified container does not exist.')
+
+    def _blob(self, container_name, blob_name):
+        try:
+            return self._container(container_name)[blob_name]
+        except KeyError:
+            raise WindowsAzureMissingResourceError(
+                'The specified blob does not exist.')
+
+    def _check_lease(self, container_name, blob_name, lease_id):
+        lease = self.account.leases.get((container_name, blob_name))
+        if lease is not None and lease[1] > time.time() and \
+                lease[0] != lease_id:
+            raise WindowsAzureError('There is currently a lease on the blob '
+                                    'and no matching lease ID was specified '
+                                    'in the request.')
+
+    def _store(self, container_name, blob_name, data, headers,
+               metadata=None, properties=None):
+        self._check_lease(container_name, blob_name,
+                          headers.get('x_ms_lease_id'))
+        properties = dict(properties or {})
+        for argument, header in _PROPERTY_HEADERS:
+            if headers.get(argument) is not None:
+                properties[header] = headers[argument]
+        properties.update({
+            'content-length': str(len(data)),
+            'etag': '"0x%s"' % uuid.uuid4().hex[:15].upper(),
+            'last-modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                           time.gmtime()),
+            'x-ms-blob-type': 'BlockBlob',
+        })
+        properties.setdefault('content-type', 'application/octet-stream')
+        for key, value in (metadata or {}).items():
+            properties['x-ms-meta-%s' % key] = value
+        self._container(container_name, create=True)[blob_name] = (
+            data, properties)
+
+    def create_container(self, container_name, x_ms_meta_name_values=None,
+                         x_ms_blob_public_access=None, fail_on_exist=False):
+        self._wait()
+        with self.account.lock:
+            if container_name in self.account.containers:
+                if fail_on_exist:
+                    raise WindowsAzureConflictError(
+                        'The specified container already exists.')
+                return False
+            self.account.containers[container_name] = {}
+            return True
+
+    def delete_container(self, container_name, fail_not_exist=False,
+                         x_ms_lease_id=None):
+        self._wait()
+        with self.account.lock:
+            if self.account.containers.pop(container_name, None) is None:
+                if fail_not_exist:
+                    raise WindowsAzureMissingResourceError(
+                        'The specified container does not exist.')
+                return False
+            return True
+
+    def put_blob(self, container_name, blob_name, blob, x_ms_blob_type,
+                 content_md5=None, x_ms_meta_name_values=None,
+                 x_ms_lease_id=None, **headers):
+        self._wait()
+        if x_ms_blob_type != 'BlockBlob':
+            raise WindowsAzureError('Only block blobs are supported.')
+        blob = _to_bytes(blob)
+        _check_md5(blob, content_md5)
+        # the service keeps the MD5 of blobs uploaded in a single request
+        properties = {'content-md5': _md5(blob)}
+        headers['x_ms_lease_id'] = x_ms_lease_id
+        with self.account.lock:
+            self._store(container_name, blob_name, blob, headers,
+                        x_ms_meta_name_values, properties)
+
+    def put_block(self, container_name, blob_name, block, blockid,
+                  content_md5=None, x_ms_lease_id=None):
+        self._wait()
+        block = _to_bytes(block)
+        _check_md5(block, content_md5)
+        with self.account.lock:
+            self.account.blocks.setdefault(
+                (container_name, blob_name), {})[blockid] = block
+
+    def put_block_list(self, container_name, blob_name, block_list,
+                       content_md5=None, x_ms_meta_name_values=None,
+                       x_ms_lease_id=None, **headers):
+        self._wait()
+        with self.account.lock:
+            blocks = self.account.blocks.get((container_name, blob_name), {})
+            try:
+                data = b''.join(blocks[blockid] for blockid in block_list)
+            except KeyError:
+                raise WindowsAzureError('The specified block list is '
+                                        'invalid.')
+            headers['x_ms_lease_id'] = x_ms_lease_id
+            self._store(container_name, blob_name, data, headers,
+                        x_ms_meta_name_values)
+            self.account.blocks.pop((container_name, blob_name), None)
+
+    def get_blob(self, container_name, blob_name, snapshot=None,
+                 x_ms_range=None, x_ms_lease_id=None,
+                 x_ms_range_get_content_md5=None):
+        self._wait()
+        with self.account.lock:
+            data, properties = self._blob(container_name, blob_name)
+        if properties.get('x-ms-access-tier') == 'Archive':
+            raise WindowsAzureConflictError(
+                'This operation is not permitted on an archived blob.')
+        properties = HeaderDict(properties)
+        if x_ms_range:
+            start, end = x_ms_range.split('=', 1)[1].split('-')
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            if start >= len(data):
+                raise WindowsAzureError('The range specified is invalid for '
+                                        'the current size of the resource.')
+            properties['content-range'] = 'bytes %d-%d/%d' % (start, end,
+                                                              len(data))
+            data = data[start:end + 1]
+            properties['content-length'] = str(len(data))
+        return BlobResult(data, properties)
+
+    def get_blob_properties(self, container_name, blob_name,
+                            x_ms_lease_id=None):
+        self._wait()
+        with self.account.lock:
+            return HeaderDict(self._blob(container_name, blob_name)[1])
+
+    def copy_blob(self, container_name, blob_name, x_ms_copy_source,
+                  x_ms_meta_name_values=None, **kwargs):
+        self._wait()
+        url = urlparse(x_ms_copy_source)
+        path = unquote(url.path).lstrip('/')
+        if url.hostname in ('127.0.0.1', 'localhost'):
+            # path style url of the emulator
+            account_name, path = path.split('/', 1)
+        else:
+            account_name = url.hostname.split('.', 1)[0]
+        source_container, source_name = path.split('/', 1)
+        with _accounts_lock:
+            account = _accounts.get(account_name)
+        if account is None:
+            raise WindowsAzureMissingResourceError(
+                'The specified resource does not exist.')
+        with account.lock:
+            source = MemoryBlobService(account_name, latency=0)
+            data, properties = source._blob(source_container, source_name)
+        if x_ms_meta_name_values is not None:
+            properties = dict((key, value) for key, value
+                              in properties.items()
+                              if not key.startswith('x-ms-meta-'))
+        with self.account.lock:
+            self._store(container_name, blob_name, data, {},
+                        x_ms_meta_name_values, properties)
+        return HeaderDict({'x-ms-copy-id': str(uuid.uuid4()),
+                           'x-ms-copy-status': 'success'})
+
+    def set_blob_properties(self, container_name, blob_name,
+                            x_ms_lease_id=None, **headers):
+        """
+        Like the service, clears the properties that are not given
+        """
+        self._wait()
+        with self.account.lock:
+            self._check_lease(container_name, blob_name, x_ms_lease_id)
+            properties = self._blob(container_name, blob_name)[1]
+            for argument, header in _PROPERTY_HEADERS:
+                properties.pop(header, None)
+                if headers.get(argument) is not None:
+                    properties[header] = headers[argument]
+            properties.setdefault('content-type', 'application/octet-stream')
+            properties.update({
+                'etag': '"0x%s"' % uuid.uuid4().hex[:15].upper(),
+                'last-modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                               time.gmtime()),
+            })
+
+    def lease_blob(self, container_name, blob_name, x_ms_lease_action,
+                   x_ms_lease_id=None, x_ms_lease_duration=60, **kwargs):
+        """
+        Supports acquiring and releasing leases
+        """
+        self._wait()
+        key = (container_name, blob_name)
+        with self.account.lock:
+            self._blob(container_name, blob_name)
+            lease = self.account.leases.get(key)
+            active = lease is not None and lease[1] > time.time()
+            if x_ms_lease_action == 'acquire':
+                if active:
+                    raise WindowsAzureConflictError(
+                        'There is already a lease present.')
+                lease_id = str(uuid.uuid4())
+                duration = int(x_ms_lease_duration)
+                self.account.leases[key] = (
+                    lease_id, time.time() + duration if duration > 0
+                    else float('inf'))
+                return HeaderDict({'x-ms-lease-id': lease_id})
+            if x_ms_lease_action == 'release':
+                if active and lease[0] != x_ms_lease_id:
+                    raise WindowsAzureConflictError(
+                        'The lease ID specified did not match the lease ID '
+                        'for the blob.')
+                self.account.leases.pop(key, None)
+                return HeaderDict()
+            raise WindowsAzureError('Unsupported lease action %s' %
+                                    x_ms_lease_action)
+
+    def delete_blob(self, container_name, blob_name, snapshot=None,
+                    timeout=None, x_ms_lease_id=None,
+                    x_ms_delete_snapshots=None):
+        self._wait()
+        with self.account.lock:
+            if self._container(container_name).pop(blob_name, None) is None:
+                raise WindowsAzureMissingResourceError(
+                    'The specified blob does not exist.')
+
+    def set_blob_tier(self, container_name, blob_name, tier):
+        """
+        Like django_azure.tiers.set_blob_tier. Rehydration from the Archive
+        tier completes immediately.
+        """
+        self._wait()
+        with self.account.lock:
+            self._blob(container_name, blob_name)[1]['x-ms-access-tier'] = tier
+
+    def get_blob_tier(self, container_name, blob_name):
+        self._wait()
+        with self.account.lock:
+            properties = self._blob(container_name, blob_name)[1]
+            return properties.get('x-ms-access-tier', 'Hot'), None
+
+    def iter_blob_tiers(self, container_name, prefix=None):
+        self._wait()
+        with self.account.lock:
+            blobs = sorted(
+                (name, properties['last-modified'],
+                 properties.get('x-ms-access-tier', 'Hot'), None)
+                for name, (data, properties)
+                in self._container(container_name).items()
+                if name.startswith(prefix or ''))
+        return iter(blobs)
+
+    def list_blobs(self, container_name, prefix=None, marker=None,
+                   maxresults=None, include=None, delimiter=None):
+        self._wait()
+        prefix = prefix or ''
+        maxresults = maxresults or 5000
+        with self.account.lock:
+            names = sorted(name for name in self._container(container_name)
+                           if name.startswith(prefix) and
+                           (not marker or name >= marker))
+            blobs = dict((name, self._container(container_name)[name])
+                         for name in names)
+        results = BlobEnumResults()
+        results.prefix = prefix
+        results.marker = marker or ''
+        results.max_results = maxresults
+        results.delimiter = delimiter or ''
+        seen = set()
+        for name in names:
+            directory = None
+            if delimiter and delimiter in name[len(prefix):]:
+                directory = name[:name.index(delimiter, len(prefix)) + 1]
+                if directory in seen:
+                    continue
+            if len(results.blobs) + len(results.prefixes) == maxresults:
+                results.next_marker = name
+                break
+            if directory is not None:
+                seen.add(directory)
+                blob_prefix = BlobPrefix()
+                blob_prefix.name = directory
+                results.prefixes.append(blob_prefix)
+                continue
+            results.blobs.append(self._listed_blob(container_name, name,
+                                                   include, *blobs[name]))
+        return results
+
+    def _listed_blob(self, container_name, name, include, data, properties):
+        blob = Blob()
+        blob.name = name
+        blob.url = self.make_blob_url(container_name, name)
+        for attribute, header in _LISTED_PROPERTIES:
+            setattr(blob.properties, attribute, properties.get(header, u''))
+        blob.properties.content_length = len(data)
+        if 'metadata' in (include or '').split(','):
+            blob.metadata = dict((key[len('x-ms-meta-'):], value)
+                                 for key, value in properties.items()
+                                 if key.startswith('x-ms-meta-'))
+        return blob
+
+    def make_blob_url(self, container_name, blob_name, account_name=None,
+                      protocol=None, host_base=None):
+        return '{0}://{1}{2}/{3}/{4}'.format(
+            protocol or self.protocol, account_name or self.account_name,
+            host_base or self.host_base, container_name, blob_name)
@@ -0,0 +1,161 @@
+import logging
+import random
+import threading
+import time
+from azure import DEFAULT_HTTP_TIMEOUT, WindowsAzureError
+from azure.http import HTTPError
+from . import settings as ls
+from .instrumentation import record_event
+
+
+logger = logging.getLogger('django_azure')
+
+# responses worth trying again, and those meaning the account is throttled
+RETRY_STATUSES = (408, 500, 502, 503, 504)
+THROTTLED_STATUSES = (503,)
+
+
+class CircuitOpenError(WindowsAzureError):
+    """
+    Raised without calling the service while it is throttling the account
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive throttled responses from an account. Past
+    ``threshold`` of them, calls fail immediately for ``cooldown`` seconds
+    instead of queueing up behind the throttling; a single call then goes
+    through to probe the service again.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self.open_until > time.time():
+                raise CircuitOpenError('The account is throttled; calls are '
+                                       'suspended for %.1f more seconds' % (
+                                           self.open_until - time.time()))
+            if self.open_until:
+                # let this call probe the service, hold the others back
+                self.open_until = time.time() + self.cooldown
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if not self.open_until:
+                    self.opened += 1
+                    record_event('circuit_open')
+                    logger.warning('Azure is throttling: suspending calls '
+                                   'for %s seconds', self.cooldown)
+                self.open_until = time.time() + self.cooldown
+
+
+def request_kind(request):
+    """
+    Tells whether a service request reads, writes, lists or deletes
+    """
+    if ('comp', 'list') in request.query:
+        return 'list'
+    if request.method in ('GET', 'HEAD'):
+        return 'read'
+    if request.method == 'DELETE':
+        return 'delete'
+    return 'write'
+
+
+def _retry_after(error):
+    for header, value in getattr(error, 'respheader', None) or ():
+        if header.lower() == 'retry-after':
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+class RetryPolicy(object):
+    """
+    A BlobService filter that applies the AZURE_TIMEOUTS of each kind of
+    request, retries failed ones with exponential backoff and full jitter
+    (or as long as the service asks with Retry-After), and reports the
+    retries and throttling to the circuit breaker of the account.
+    """
+    def __init__(self, breaker, httpclient=None, retries=None, backoff=None,
+                 max_backoff=None, timeouts=None):
+        self.breaker = breaker
+        self.httpclient = httpclient
+        self.retries = ls.AZURE_RETRIES if retries is None else retries
+        self.backoff = ls.AZURE_RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = (ls.AZURE_RETRY_MAX_BACKOFF if max_backoff is None
+                            else max_backoff)
+        self.timeouts = ls.AZURE_TIMEOUTS if timeouts is None else timeouts
+
+    def delay(self, attempt, error):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def __call__(self, request, next):
+        kind = request_kind(request)
+        if self.httpclient is not None:
+            self.httpclient.timeout = self.timeouts.get(kind,
+                                                        DEFAULT_HTTP_TIMEOUT)
+        attempt = 0
+        while True:
+            self.breaker.check()
+            started = time.time()
+            try:
+                response = next(request)
+            except HTTPError as e:
+                error = e
+                if e.status in THROTTLED_STATUSES:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                if e.status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise
+            except EnvironmentError as e:
+                # connection errors and timeouts
+                error = e
+                if attempt >= self.retries:
+                    raise
+            else:
+                self.breaker.success()
+                return response
+            delay = self.delay(attempt, error)
+            record_event('retry.%s' % kind, time.time() - started, error)
+            logger.info('Retrying %s %s in %.1fs after: %s', request.method,
+                        request.path, delay, error)
+            time.sleep(delay)
+            attempt += 1
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(key):
+    """
+    Returns the circuit breaker shared by the services of an account
+    """
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(
+                ls.AZURE_CIRCUIT_BREAKER_THRESHOLD,
+                ls.AZURE_CIRCUIT_BREAKER_COOLDOWN)
+        return _breakers[key]
@@ -6,13 +6,116 @@ AZURE_ACCOUNT_KEY = getattr(settings, 'AZURE_ACCOUNT_KEY', None)
 AZURE_DEFAULT_CONTAINER = getattr(settings, 'AZURE_DEFAULT_CONTAINER', None)
 AZURE_TEST_CONTAINER = getattr(settings, 'AZURE_TEST_CONTAINER', None)
 AZURE_STATIC_FILES_CONTAINER = getattr(settings, 'AZURE_STATIC_FILES_CONTAINER', None)
+AZURE_STATIC_MANIFEST_NAME = getattr(settings, 'AZURE_STATIC_MANIFEST_NAME',
+                                     'staticfiles.json')
+AZURE_STATIC_CACHE_CONTROL = getattr(settings, 'AZURE_STATIC_CACHE_CONTROL',
+                                     'public, max-age=31536000, immutable')
+# list the static container once and upload in parallel during
+# collectstatic, see StaticFilesAzureStorage
+AZURE_STATIC_FAST_COLLECT = getattr(settings, 'AZURE_STATIC_FAST_COLLECT', False)
+AZURE_STATIC_UPLOAD_CONCURRENCY = getattr(settings,
+                                          'AZURE_STATIC_UPLOAD_CONCURRENCY', 8)
 AZURE_CDN_HOST = getattr(settings, 'AZURE_CDN_HOST', None)
 AZURE_DEFAULT_PROTOCOL = getattr(settings, 'AZURE_DEFAULT_PROTOCOL', 'https')
 AZURE_BLOB_OVERWRITE = getattr(settings, 'AZURE_BLOB_OVERWRITE', True)
+# skip saving content whose MD5 matches the blob already at that name
+AZURE_DEDUPE_UPLOADS = getattr(settings, 'AZURE_DEDUPE_UPLOADS', False)
 AZURE_GZIPPED_CONTENT = getattr(settings, 'AZURE_GZIPPED_CONTENT', False)
 AZURE_GZIPPED_CONTENT_TYPES = getattr(settings, 'AZURE_GZIPPED_CONTENT_TYPES',
                                       ('text/css', 'text/javascript',
                                        'application/javascript',
                                        'application/x-javascript'))
+# compression level and brotli (https://pypi.python.org/pypi/Brotli) setup;
+# brotli takes precedence over gzip for content types enabled in both
+AZURE_GZIP_LEVEL = getattr(settings, 'AZURE_GZIP_LEVEL', 6)
+AZURE_BROTLI_CONTENT = getattr(settings, 'AZURE_BROTLI_CONTENT', False)
+AZURE_BROTLI_CONTENT_TYPES = getattr(settings, 'AZURE_BROTLI_CONTENT_TYPES',
+                                     AZURE_GZIPPED_CONTENT_TYPES)
+AZURE_BROTLI_QUALITY = getattr(settings, 'AZURE_BROTLI_QUALITY', 5)
+# content is stored uncompressed if compressing its first block leaves it
+# larger than this fraction of the original size
+AZURE_COMPRESSION_MAX_RATIO = getattr(settings, 'AZURE_COMPRESSION_MAX_RATIO',
+                                      1.0)
+# files larger than this are streamed as blocks of AZURE_BLOCK_SIZE bytes,
+# AZURE_UPLOAD_CONCURRENCY of them in flight at a time
+AZURE_SINGLE_PUT_THRESHOLD = getattr(settings, 'AZURE_SINGLE_PUT_THRESHOLD',
+                                     4 * 1024 * 1024)
+AZURE_BLOCK_SIZE = getattr(settings, 'AZURE_BLOCK_SIZE', 4 * 1024 * 1024)
+AZURE_UPLOAD_CONCURRENCY = getattr(settings, 'AZURE_UPLOAD_CONCURRENCY', 4)
+# AzureUploadHandler streams uploads to temporary blobs under this prefix
+# of this container; saving them to a FileField moves them in the service
+AZURE_UPLOAD_CONTAINER = getattr(settings, 'AZURE_UPLOAD_CONTAINER',
+                                 AZURE_DEFAULT_CONTAINER)
+AZURE_UPLOAD_PREFIX = getattr(settings, 'AZURE_UPLOAD_PREFIX', 'uploads/')
+# operations running at once in save_many, delete_many and exists_many
+AZURE_BULK_CONCURRENCY = getattr(settings, 'AZURE_BULK_CONCURRENCY', 8)
+# read-ahead window of the files returned by AzureStorage.open
+AZURE_READ_BUFFER_SIZE = getattr(settings, 'AZURE_READ_BUFFER_SIZE',
+                                 256 * 1024)
+# keep-alive connections pooled per account (requires requests)
+AZURE_CONNECTION_POOL_SIZE = getattr(settings, 'AZURE_CONNECTION_POOL_SIZE', 10)
+# failed requests are retried up to AZURE_RETRIES times, after a random
+# delay of up to AZURE_RETRY_BACKOFF seconds doubled on every attempt
+# (capped at AZURE_RETRY_MAX_BACKOFF) or the delay asked with Retry-After
+AZURE_RETRIES = getattr(settings, 'AZURE_RETRIES', 3)
+AZURE_RETRY_BACKOFF = getattr(settings, 'AZURE_RETRY_BACKOFF', 0.5)
+AZURE_RETRY_MAX_BACKOFF = getattr(settings, 'AZURE_RETRY_MAX_BACKOFF', 30)
+# request timeouts in seconds by kind: 'read', 'write', 'list', 'delete'
+AZURE_TIMEOUTS = getattr(settings, 'AZURE_TIMEOUTS', {})
+# after that many consecutive throttled responses, calls to the account
+# fail immediately for AZURE_CIRCUIT_BREAKER_COOLDOWN seconds (0 disables)
+AZURE_CIRCUIT_BREAKER_THRESHOLD = getattr(
+    settings, 'AZURE_CIRCUIT_BREAKER_THRESHOLD', 10)
+AZURE_CIRCUIT_BREAKER_COOLDOWN = getattr(
+    settings, 'AZURE_CIRCUIT_BREAKER_COOLDOWN', 30)
+# dotted path of the blob service class, e.g.
+# 'django_azure.memory.MemoryBlobService' to keep blobs in memory
+AZURE_BLOB_SERVICE = getattr(settings, 'AZURE_BLOB_SERVICE', None)
+# seconds every call to MemoryBlobService waits, to simulate the network
+AZURE_MEMORY_LATENCY = getattr(settings, 'AZURE_MEMORY_LATENCY', 0)
+# worker threads behind the awaitable methods of AsyncAzureStorage
+AZURE_ASYNC_CONCURRENCY = getattr(settings, 'AZURE_ASYNC_CONCURRENCY', 10)
+# CachedAzureStorage saves locally and uploads in the background; pending
+# uploads are kept in AZURE_WRITE_BEHIND_QUEUE_DIR (by default a directory
+# under the local storage location)
+AZURE_WRITE_BEHIND = getattr(settings, 'AZURE_WRITE_BEHIND', False)
+AZURE_WRITE_BEHIND_QUEUE_DIR = getattr(settings, 'AZURE_WRITE_BEHIND_QUEUE_DIR',
+                                       None)
+AZURE_WRITE_BEHIND_WORKERS = getattr(settings, 'AZURE_WRITE_BEHIND_WORKERS', 2)
+AZURE_WRITE_BEHIND_RETRIES = getattr(settings, 'AZURE_WRITE_BEHIND_RETRIES', 5)
+# dotted path of a django_azure.instrumentation.BaseCollector subclass
+AZURE_METRICS_COLLECTOR = getattr(settings, 'AZURE_METRICS_COLLECTOR', None)
+# None disables caching of blob properties, 'local' keeps them in an
+# in-process LRU and any other value is the alias of a Django cache
+AZURE_PROPERTIES_CACHE = getattr(settings, 'AZURE_PROPERTIES_CACHE', None)
+AZURE_PROPERTIES_CACHE_TIMEOUT = getattr(settings,
+                                         'AZURE_PROPERTIES_CACHE_TIMEOUT', 300)
+AZURE_PROPERTIES_CACHE_MAX_ENTRIES = getattr(
+    settings, 'AZURE_PROPERTIES_CACHE_MAX_ENTRIES', 10000)
+# directory where opened blobs are kept, revalidated by ETag, until they
+# take more than AZURE_DISK_CACHE_SIZE bytes. None disables it.
+AZURE_DISK_CACHE_DIR = getattr(settings, 'AZURE_DISK_CACHE_DIR', None)
+AZURE_DISK_CACHE_SIZE = getattr(settings, 'AZURE_DISK_CACHE_SIZE',
+                                1024 * 1024 * 1024)
+# seconds copy() waits for a pending server-side copy (also the lifetime
+# of the signed url a copy from another account reads), polling every
+# AZURE_COPY_POLL_INTERVAL seconds at first
+AZURE_COPY_TIMEOUT = getattr(settings, 'AZURE_COPY_TIMEOUT', 3600)
+AZURE_COPY_POLL_INTERVAL = getattr(settings, 'AZURE_COPY_POLL_INTERVAL', 1)
+# access tier of uploaded blobs: the first (name pattern, content type
+# pattern, tier) rule matching a blob applies, e.g. ('backups/*', None,
+# 'Cool') or (None, 'video/*', 'Cool'); None patterns match anything
+AZURE_TIER_RULES = getattr(settings, 'AZURE_TIER_RULES', ())
+# tier archived blobs are rehydrated to when they are read
+AZURE_REHYDRATE_TIER = getattr(settings, 'AZURE_REHYDRATE_TIER', 'Hot')
+# when set, url() returns Shared Access Signature urls valid for at least
+# this many seconds. Expiry times are rounded up to AZURE_URL_EXPIRE_BUCKET
+# seconds, so that urls can be reused from a cache of AZURE_URL_CACHE_SIZE
+AZURE_URL_EXPIRE = getattr(settings, 'AZURE_URL_EXPIRE', None)
+AZURE_URL_EXPIRE_BUCKET = getattr(settings, 'AZURE_URL_EXPIRE_BUCKET', 300)
+AZURE_URL_CACHE_SIZE = getattr(settings, 'AZURE_URL_CACHE_SIZE', 10000)
+# append ?v=<ETag> to the urls of blobs found in the properties cache
+AZURE_URL_VERSIONING = getattr(settings, 'AZURE_URL_VERSIONING', False)
 
 TIMESTAMP_FORMAT = u'%a, %d %b %Y %H:%M:%S %Z'
+SAS_TIMESTAMP_FORMAT = u'%Y-%m-%dT%H:%M:%SZ'
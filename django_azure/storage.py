@@ -1,13 +1,199 @@
-import StringIO
-import gzip
+import atexit
+import functools
+import hashlib
+import itertools
+import json
 import mimetypes
+import os
+import threading
+import time
+import zlib
 from datetime import datetime
-from urllib import quote
-from django.core.files.base import ContentFile
+from email.utils import parsedate
+from django.core.files.base import ContentFile, File
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import Storage
-from azure import WindowsAzureMissingResourceError
-from azure.storage.blobservice import BlobService
+from django.core.files.uploadedfile import UploadedFile
+from django.utils.encoding import force_bytes
+from azure import (BLOB_SERVICE_HOST_BASE, WindowsAzureConflictError,
+                   WindowsAzureError, WindowsAzureMissingResourceError)
+from azure.storage import AccessPolicy
+from azure.storage.sharedaccesssignature import (SharedAccessPolicy,
+                                                 SharedAccessSignature)
 from . import settings as ls
+from .client import get_blob_service
+from .instrumentation import instrumented, record, record_event
+from .cache import get_disk_cache, get_properties_cache
+from .tiers import (ARCHIVE, BlobArchivedError, get_blob_tier, set_blob_tier,
+                    tier_for)
+from .utils import BoundedPool, LRUCache, md5_digest, put_blocks, rechunk
+from .writebehind import UploadQueue
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# metadata keeping the MD5 of compressed blobs before compression
+SOURCE_MD5 = 'sourcemd5'
+
+
+def source_md5(blob):
+    """
+    Returns the Content-MD5 a listed blob had before being compressed,
+    when listed with its metadata, or its Content-MD5
+    """
+    return (blob.metadata or {}).get(SOURCE_MD5) or \
+        blob.properties.content_md5
+
+
+class AzureFile(File):
+    """
+    A read-only, seekable file backed by a blob. Bytes are fetched on
+    demand with ranged GETs, through a read-ahead buffer of
+    ``buffer_size`` bytes.
+    """
+    def __init__(self, name, storage, mode='rb',
+                 buffer_size=ls.AZURE_READ_BUFFER_SIZE):
+        self.file = None
+        self.name = name
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self._storage = storage
+        self._closed = False
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_start = 0
+
+    def _get_size(self):
+        if not hasattr(self, '_size'):
+            self._size = self._storage.size(self.name)
+        return self._size
+
+    def _set_size(self, size):
+        self._size = size
+
+    size = property(_get_size, _set_size)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _fetch(self, start, end=None):
+        """
+        Returns the bytes from ``start`` up to ``end`` inclusive, or up to
+        the end of the blob if ``end`` is None.
+        """
+        if hasattr(self, '_size') and start >= self._size:
+            return b''
+        x_ms_range = u'bytes={0}-{1}'.format(start, '' if end is None else end)
+        started = time.time()
+        try:
+            data = self._storage.service.get_blob(
+                container_name=self._storage.container, blob_name=self.name,
+                x_ms_range=x_ms_range)
+        except WindowsAzureError as e:
+            record(self._storage, 'read', self.name, time.time() - started,
+                   error=e)
+            if isinstance(e, WindowsAzureConflictError):
+                self._storage._rehydrate(self.name)
+            # ranges past the end of the blob are rejected by the service
+            if not hasattr(self, '_size') and start >= self.size:
+                return b''
+            raise
+        record(self._storage, 'read', self.name, time.time() - started,
+               size=len(data))
+        content_range = data.properties.get('content-range')
+        if content_range:
+            self._size = int(content_range.rsplit('/', 1)[1])
+        return data
+
+    def read(self, num_bytes=None):
+        offset = self._pos - self._buffer_start
+        if 0 <= offset < len(self._buffer):
+            if num_bytes is None or num_bytes < 0:
+                data = self._buffer[offset:]
+            else:
+                data = self._buffer[offset:offset + num_bytes]
+            self._pos += len(data)
+        else:
+            data = b''
+
+        if num_bytes is None or num_bytes < 0:
+            extra = self._fetch(self._pos)
+        elif len(data) < num_bytes:
+            missing = num_bytes - len(data)
+            if missing >= self.buffer_size:
+                extra = self._fetch(self._pos, self._pos + missing - 1)
+            else:
+                self._buffer_start = self._pos
+                self._buffer = self._fetch(self._pos,
+                                           self._pos + self.buffer_size - 1)
+                extra = self._buffer[:missing]
+        else:
+            extra = b''
+        self._pos += len(extra)
+        return data + extra
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('Negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def chunks(self, chunk_size=None):
+        """
+        Streams the whole blob, one ranged GET per chunk, bypassing the
+        read-ahead buffer.
+        """
+        chunk_size = chunk_size or self.buffer_size
+        self.seek(0)
+        while True:
+            data = self._fetch(self._pos, self._pos + chunk_size - 1)
+            if not data:
+                break
+            self._pos += len(data)
+            yield data
+
+    def open(self, mode=None):
+        self.seek(0)
+        self._closed = False
+        if mode is not None:
+            self.mode = mode
+        return self
+
+    def close(self):
+        self._buffer = b''
+        self._closed = True
+
+
+class AzureUploadedFile(UploadedFile):
+    """
+    A file uploaded by AzureUploadHandler, already stored as the blob
+    ``blob_name`` of ``storage``. Saving it to an AzureStorage of the same
+    account copies the blob on the service side instead of uploading it
+    again; the first save moves it, so the temporary blob goes away.
+    """
+    def __init__(self, storage, blob_name, name, content_type, size,
+                 charset, content_type_extra=None):
+        super(AzureUploadedFile, self).__init__(
+            AzureFile(blob_name, storage,
+                      buffer_size=storage.read_buffer_size),
+            name, content_type, size, charset)
+        self.content_type_extra = content_type_extra
+        self.storage = storage
+        self.blob_name = blob_name
+        self.temporary = True
 
 
 class AzureStorage(Storage):
@@ -16,71 +202,542 @@ class AzureStorage(Storage):
     """
     account_name = ls.AZURE_ACCOUNT_NAME
     account_key = ls.AZURE_ACCOUNT_KEY
+    cache_control = None
 
     def __init__(self, container=ls.AZURE_DEFAULT_CONTAINER,
                  cdn_host=ls.AZURE_CDN_HOST,
                  protocol=ls.AZURE_DEFAULT_PROTOCOL,
                  allow_override=ls.AZURE_BLOB_OVERWRITE,
                  gzipped=ls.AZURE_GZIPPED_CONTENT,
-                 gzipped_content_types=ls.AZURE_GZIPPED_CONTENT_TYPES):
-        self._service = None
+                 gzipped_content_types=ls.AZURE_GZIPPED_CONTENT_TYPES,
+                 gzip_level=ls.AZURE_GZIP_LEVEL,
+                 brotli=ls.AZURE_BROTLI_CONTENT,
+                 brotli_content_types=ls.AZURE_BROTLI_CONTENT_TYPES,
+                 brotli_quality=ls.AZURE_BROTLI_QUALITY,
+                 compression_max_ratio=ls.AZURE_COMPRESSION_MAX_RATIO,
+                 single_put_threshold=ls.AZURE_SINGLE_PUT_THRESHOLD,
+                 block_size=ls.AZURE_BLOCK_SIZE,
+                 upload_concurrency=ls.AZURE_UPLOAD_CONCURRENCY,
+                 read_buffer_size=ls.AZURE_READ_BUFFER_SIZE,
+                 properties_cache=ls.AZURE_PROPERTIES_CACHE,
+                 properties_cache_timeout=ls.AZURE_PROPERTIES_CACHE_TIMEOUT,
+                 url_expire=ls.AZURE_URL_EXPIRE,
+                 bulk_concurrency=ls.AZURE_BULK_CONCURRENCY,
+                 disk_cache_dir=ls.AZURE_DISK_CACHE_DIR,
+                 disk_cache_size=ls.AZURE_DISK_CACHE_SIZE,
+                 dedupe=ls.AZURE_DEDUPE_UPLOADS,
+                 url_versioning=ls.AZURE_URL_VERSIONING,
+                 tier_rules=ls.AZURE_TIER_RULES,
+                 rehydrate_tier=ls.AZURE_REHYDRATE_TIER):
         self.container = container
         self.cdn_host = cdn_host
         self.protocol = protocol
         self.allow_override = allow_override
         self.gzipped = gzipped
         self.gzipped_content_types = gzipped_content_types
+        self.gzip_level = gzip_level
+        self.brotli = brotli
+        self.brotli_content_types = brotli_content_types
+        self.brotli_quality = brotli_quality
+        self.compression_max_ratio = compression_max_ratio
+        self.single_put_threshold = single_put_threshold
+        self.block_size = block_size
+        self.upload_concurrency = upload_concurrency
+        self.read_buffer_size = read_buffer_size
+        self.properties_cache = get_properties_cache(
+            properties_cache, properties_cache_timeout,
+            ls.AZURE_PROPERTIES_CACHE_MAX_ENTRIES)
+        self.url_expire = url_expire
+        self.bulk_concurrency = bulk_concurrency
+        self.disk_cache = get_disk_cache(disk_cache_dir, disk_cache_size)
+        self.dedupe = dedupe
+        self.url_versioning = url_versioning
+        self.tier_rules = tier_rules
+        self.rehydrate_tier = rehydrate_tier
+        self._url_bases = {}
+        self._quoted_names = LRUCache(ls.AZURE_URL_CACHE_SIZE)
+        self._signed_urls = LRUCache(ls.AZURE_URL_CACHE_SIZE)
 
     def _clean_name(self, name):
         return name.replace("\\", "/")
 
-    def _compress_content(self, content):
-        """ Gzips a string content """
-        zbuf = StringIO.StringIO()
-        zfile = gzip.GzipFile(mode="wb", compresslevel=6, fileobj=zbuf)
+    def _content_encoding(self, content_type):
+        """
+        Returns the encoding content of the given type is stored with
+        """
+        if self.brotli and content_type in self.brotli_content_types:
+            if brotli is None:
+                raise ImproperlyConfigured('AZURE_BROTLI_CONTENT requires '
+                                           'the brotli package')
+            return 'br'
+        if self.gzipped and content_type in self.gzipped_content_types:
+            return 'gzip'
+        return None
 
-        zfile.write(content.read())
-        zfile.close()
+    def _get_compressor(self, encoding):
+        """
+        Returns the compress, sync flush and finish functions of a
+        streaming compressor for the given encoding
+        """
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process, compressor.flush, compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return (compressor.compress,
+                lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                compressor.flush)
 
-        content.seek(0)
+    def _compress_content(self, content, encoding):
+        """
+        Compresses the content as a stream of chunks. Returns the encoding
+        actually applied and the chunks; the content is passed through
+        uncompressed if its first block does not shrink below
+        compression_max_ratio.
+        """
+        compress, flush, finish = self._get_compressor(encoding)
+        chunks = content.chunks(self.block_size)
+        first = next(chunks, b'')
+        compressed = compress(force_bytes(first)) + flush()
+        if first and len(compressed) > len(first) * self.compression_max_ratio:
+            return None, itertools.chain([first], chunks)
 
-        return ContentFile(zbuf.getvalue())
+        def compressed_chunks():
+            yield compressed
+            for chunk in chunks:
+                yield compress(force_bytes(chunk))
+            yield finish()
+        return encoding, compressed_chunks()
 
     def _get_properties(self, name):
-        return self.service.get_blob_properties(container_name=self.container,
-                                                blob_name=name)
+        if self.properties_cache is not None:
+            properties = self.properties_cache.get(self.container, name)
+            if properties is not None:
+                return properties
+        properties = self.service.get_blob_properties(
+            container_name=self.container, blob_name=name)
+        if self.properties_cache is not None:
+            self.properties_cache.set(self.container, name, properties)
+        return properties
 
+    def _cache_listed_blobs(self, blobs):
+        """
+        Fills the properties cache from the results of list_blobs
+        """
+        if self.properties_cache is None:
+            return
+        self.properties_cache.set_many(self.container, dict(
+            (blob.name, {'content-length': str(blob.properties.content_length),
+                         'content-type': blob.properties.content_type,
+                         'content-encoding': blob.properties.content_encoding,
+                         'content-md5': blob.properties.content_md5,
+                         'etag': blob.properties.etag,
+                         'last-modified': blob.properties.last_modified})
+            for blob in blobs))
+
+    def _invalidate_properties(self, name):
+        if self.properties_cache is not None:
+            self.properties_cache.delete(self.container, name)
+        if self.disk_cache is not None:
+            self.disk_cache.delete(self.container, name)
+
+    @instrumented('open')
     def _open(self, name, mode='rb'):
-        return ContentFile(self.service.get_blob(container_name=self.container,
-                                                 blob_name=name))
+        """
+        Returns the blob as a lazy AzureFile, or from the disk cache.
+        Reading an archived blob requests its rehydration and raises
+        BlobArchivedError instead of a bare conflict error.
+        """
+        if self.disk_cache is not None:
+            cached = self._open_cached(name)
+            if cached is not None:
+                return cached
+        return AzureFile(name, self, mode, buffer_size=self.read_buffer_size)
+
+    def _open_cached(self, name):
+        """
+        Returns the copy of the blob in the disk cache, downloading it
+        first unless the cached copy has the current ETag. Returns None if
+        the blob could not be cached.
+        """
+        properties = self._get_properties(name)
+        etag = properties['etag']
+        cached = self.disk_cache.open(self.container, name, etag)
+        if cached is None:
+            try:
+                self.disk_cache.put(self.container, name, etag,
+                                    self._download(name, etag, int(
+                                        properties['content-length'])))
+            except IOError:
+                self._invalidate_properties(name)
+                return None
+            except WindowsAzureConflictError:
+                self._rehydrate(name)
+                raise
+            cached = self.disk_cache.open(self.container, name, etag)
+        return cached
 
+    def _download(self, name, etag, size):
+        """
+        Yields the blob in ranges of block_size bytes, making sure they all
+        belong to the version with the given ETag
+        """
+        for start in range(0, size, self.block_size):
+            started = time.time()
+            data = self.service.get_blob(
+                container_name=self.container, blob_name=name,
+                x_ms_range=u'bytes={0}-{1}'.format(
+                    start, min(start + self.block_size, size) - 1))
+            record(self, 'read', name, time.time() - started, size=len(data))
+            if data.properties.get('etag') != etag:
+                raise IOError('%s changed while downloading' % name)
+            yield data
+
+    @instrumented('save',
+                  lambda args, result: getattr(args[0], 'size', None) or 0)
     def _save(self, name, content):
+        if isinstance(content, AzureUploadedFile) and \
+                content.storage.account_name == self.account_name:
+            return self._save_uploaded(name, content)
         extra_headers = {}
+        if self.cache_control:
+            extra_headers['x_ms_blob_cache_control'] = self.cache_control
 
         if hasattr(content.file, 'content_type'):
             content_type = content.file.content_type
         else:
             content_type = mimetypes.guess_type(name)[0] or u'application/octet-stream'
 
-        if self.gzipped and content_type in self.gzipped_content_types:
-            content = self._compress_content(content)
-            extra_headers.update({'x_ms_blob_content_encoding': 'gzip'})
+        encoding = self._content_encoding(content_type)
+        if encoding is None and self.dedupe and \
+                self._is_unchanged(name, content):
+            return name
+        if encoding is not None:
+            md5 = self._content_md5(content)
+            if md5 is not None:
+                extra_headers['x_ms_meta_name_values'] = {SOURCE_MD5: md5}
+            encoding, chunks = self._compress_content(content, encoding)
+            if encoding is not None:
+                extra_headers.update({'x_ms_blob_content_encoding': encoding})
+            self._put_chunks(name, chunks, x_ms_blob_content_type=content_type,
+                             **extra_headers)
+        else:
+            size = getattr(content, 'size', None)
+            if size is not None and size <= self.single_put_threshold:
+                data = force_bytes(content.read())
+                self.service.put_blob(container_name=self.container,
+                                      blob_name=name,
+                                      blob=data,
+                                      x_ms_blob_type='BlockBlob',
+                                      x_ms_blob_content_type=content_type,
+                                      content_md5=md5_digest(
+                                          hashlib.md5(data)),
+                                      **extra_headers)
+            else:
+                self._put_blocks(name, content.chunks(self.block_size),
+                                 x_ms_blob_content_type=content_type,
+                                 **extra_headers)
+        self._post_save(name, content_type)
+        return name
 
-        self.service.put_blob(container_name=self.container,
-                              blob_name=name,
-                              blob=content.read(),
-                              x_ms_blob_type='BlockBlob',
-                              x_ms_blob_content_type=content_type,
-                              **extra_headers)
+    def _post_save(self, name, content_type):
+        """
+        Moves a blob just stored to the tier its rule asks for, if any
+        """
+        tier = tier_for(self.tier_rules, name, content_type)
+        if tier is not None:
+            set_blob_tier(self.service, self.container, name, tier)
+        self._invalidate_properties(name)
+
+    def _save_uploaded(self, name, content):
+        """
+        Stores a file streamed by AzureUploadHandler with a server-side
+        copy, or a move the first time, which apply the Cache-Control
+        header and tier rules too
+        """
+        copy = self.move if content.temporary else self.copy
+        name = copy(content.blob_name, name, content.storage)
+        content.file = AzureFile(name, self,
+                                 buffer_size=self.read_buffer_size)
+        content.storage, content.blob_name = self, name
+        content.temporary = False
         return name
 
+    def _rehydrate(self, name):
+        """
+        Called when reading a blob is refused. If the blob is archived,
+        starts moving it back to rehydrate_tier (unless that is already
+        pending) and raises BlobArchivedError.
+        """
+        tier, archive_status = get_blob_tier(self.service, self.container,
+                                             name)
+        if tier != ARCHIVE:
+            return
+        if not archive_status:
+            set_blob_tier(self.service, self.container, name,
+                          self.rehydrate_tier)
+            record_event('rehydrate')
+            archive_status = 'rehydrate-pending-to-%s' % (
+                self.rehydrate_tier.lower())
+        raise BlobArchivedError('%s is archived, try again once it is '
+                                'rehydrated (%s)' % (name, archive_status),
+                                name, archive_status)
+
+    def _is_unchanged(self, name, content):
+        """
+        Tells whether the blob already holds exactly the content, from the
+        Content-MD5 the service keeps for it. Costs a HEAD (unless the
+        properties are cached) and a pass over seekable content.
+        """
+        try:
+            properties = self._get_properties(name)
+        except WindowsAzureMissingResourceError:
+            return False
+        if not properties.get('content-md5') or \
+                properties.get('content-encoding'):
+            return False
+        size = getattr(content, 'size', None)
+        if size is not None and size != int(properties['content-length']):
+            return False
+        return self._content_md5(content) == properties['content-md5']
+
+    def _content_md5(self, content):
+        """
+        Returns the Content-MD5 of seekable content, rewound afterwards,
+        or None if the content can't be read twice
+        """
+        try:
+            content.seek(0)
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+        md5 = hashlib.md5()
+        for chunk in content.chunks(self.block_size):
+            md5.update(force_bytes(chunk))
+        content.seek(0)
+        return md5_digest(md5)
+
+    def _put_chunks(self, name, chunks, **headers):
+        """
+        Uploads a stream of unknown length, with a single PUT if it turns
+        out to fit in one block, or as a block list otherwise
+        """
+        chunks = rechunk(chunks, self.block_size)
+        first = next(chunks, b'')
+        second = next(chunks, None)
+        if second is None and len(first) <= self.single_put_threshold:
+            first = force_bytes(first)
+            self.service.put_blob(container_name=self.container,
+                                  blob_name=name,
+                                  blob=first,
+                                  x_ms_blob_type='BlockBlob',
+                                  content_md5=md5_digest(hashlib.md5(first)),
+                                  **headers)
+        else:
+            self._put_blocks(name, itertools.chain([first, second], chunks),
+                             **headers)
+
+    def _put_blocks(self, name, chunks, **headers):
+        """
+        Uploads an iterable of byte chunks as the blocks of a block blob
+        and commits them. At most ``upload_concurrency`` blocks are held
+        in memory at any time.
+        """
+        put_blocks(lambda: self.service, self.container, name, chunks,
+                   self.upload_concurrency, **headers)
+
+    def _run_many(self, func, items):
+        """
+        Calls func with each tuple of arguments in items concurrently.
+        Returns a (result, error) pair per item, in order.
+        """
+        def run(args):
+            try:
+                return func(*args), None
+            except Exception as e:
+                return None, e
+        with BoundedPool(self.bulk_concurrency) as pool:
+            return pool.map(run, items)
+
+    def save_many(self, files):
+        """
+        Saves an iterable of (name, content) pairs concurrently. Returns a
+        (saved name, error) pair per file.
+        """
+        return self._run_many(self.save, files)
+
+    def delete_many(self, names):
+        """
+        Deletes the given blobs concurrently. Returns a (None, error) pair
+        per name.
+
+        The blob batch endpoint needs a newer service version than the one
+        spoken by the Azure SDK in use, so deletes are sent one per request.
+        """
+        return self._run_many(self.delete, [(name,) for name in names])
+
+    def exists_many(self, names):
+        """
+        Checks whether the given blobs exist. Returns an (exists, error)
+        pair per name. Names sharing a directory are answered from a
+        single listing of that directory, without its subdirectories,
+        instead of a request each.
+        """
+        names = list(names)
+        directories = {}
+        for name in names:
+            directories.setdefault(name[:name.rfind('/') + 1], []).append(
+                name)
+        shared = [directory for directory, members in directories.items()
+                  if len(members) > 1]
+        listings = dict(zip(shared, self._run_many(
+            self._list_names, [(directory,) for directory in shared])))
+        singles = [name for name in names
+                   if name[:name.rfind('/') + 1] not in listings]
+        checked = dict(zip(singles, self._run_many(
+            self.exists, [(name,) for name in singles])))
+        results = []
+        for name in names:
+            if name in checked:
+                results.append(checked[name])
+                continue
+            found, error = listings[name[:name.rfind('/') + 1]]
+            results.append((None, error) if error is not None
+                           else (name in found, None))
+        return results
+
+    def _list_names(self, directory):
+        """
+        Returns the names of the blobs directly in a directory
+        """
+        return set(blob.name
+                   for page in self._list_pages(prefix=directory or None,
+                                                delimiter='/')
+                   for blob in page.blobs)
+
+    def _copy_source_url(self, name, account_name):
+        """
+        Returns the url the service reads the blob from when copying it to
+        the given account, signed if that is another account
+        """
+        if account_name == self.account_name:
+            return self._url_base(use_cdn=False) + self._quote(name)
+        return self._signed_url(name, ls.AZURE_COPY_TIMEOUT, 'r')
+
+    def _wait_for_copy(self, name, status):
+        """
+        Polls the destination of a pending copy until it completes
+        """
+        properties = {}
+        delay = ls.AZURE_COPY_POLL_INTERVAL
+        deadline = time.time() + ls.AZURE_COPY_TIMEOUT
+        while status == 'pending':
+            if time.time() > deadline:
+                raise WindowsAzureError('Copy to %s still pending after %s '
+                                        'seconds' % (name,
+                                                     ls.AZURE_COPY_TIMEOUT))
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+            properties = self.service.get_blob_properties(
+                container_name=self.container, blob_name=name)
+            status = properties.get('x-ms-copy-status')
+        if status not in (None, 'success'):
+            raise WindowsAzureError('Copy to %s %s: %s' % (
+                name, status, properties.get('x-ms-copy-status-description')))
+
+    @instrumented('copy')
+    def copy(self, source, destination, source_storage=None):
+        """
+        Copies the blob ``source`` to ``destination`` within the service,
+        without its bytes going through this process, and waits until the
+        copy completes. ``source_storage`` is the storage the source is
+        in, when it is another container or account. The copy gets the
+        Cache-Control header and tier rules of this storage, at the cost
+        of a HEAD when there are any. Returns the name of the copy.
+        """
+        source_storage = source_storage or self
+        destination = self.get_available_name(destination)
+        result = self.service.copy_blob(
+            container_name=self.container, blob_name=destination,
+            x_ms_copy_source=source_storage._copy_source_url(
+                source, self.account_name))
+        self._invalidate_properties(destination)
+        self._wait_for_copy(destination, result.get('x-ms-copy-status'))
+        if self.cache_control or self.tier_rules:
+            properties = self.service.get_blob_properties(
+                container_name=self.container, blob_name=destination)
+            if self.cache_control:
+                # properties left out are cleared by the service
+                self.service.set_blob_properties(
+                    container_name=self.container, blob_name=destination,
+                    x_ms_blob_cache_control=self.cache_control,
+                    x_ms_blob_content_type=properties.get('content-type'),
+                    x_ms_blob_content_encoding=properties.get(
+                        'content-encoding'),
+                    x_ms_blob_content_language=properties.get(
+                        'content-language'),
+                    x_ms_blob_content_md5=properties.get('content-md5'))
+            self._post_save(destination, properties.get('content-type'))
+        return destination
+
+    def _same_container(self, source_storage):
+        source_storage = source_storage or self
+        return (source_storage.account_name == self.account_name and
+                source_storage.container == self.container)
+
+    def move(self, source, destination, source_storage=None):
+        """
+        Copies the blob like copy, then deletes the source, unless the
+        blob was copied onto itself
+        """
+        destination = self.copy(source, destination, source_storage)
+        if destination != source or \
+                not self._same_container(source_storage):
+            (source_storage or self).delete(source)
+        return destination
+
+    def _prefix_pairs(self, source_prefix, destination_prefix,
+                      source_storage):
+        return [(blob.name, destination_prefix + blob.name[len(
+                    source_prefix):], source_storage)
+                for blob in (source_storage or self).iter_blobs(
+                    source_prefix)]
+
+    def copy_prefix(self, source_prefix, destination_prefix,
+                    source_storage=None):
+        """
+        Copies every blob whose name starts with source_prefix to the same
+        name under destination_prefix, concurrently. Returns a (copy name,
+        error) pair per blob.
+        """
+        return self._run_many(self.copy, self._prefix_pairs(
+            source_prefix, destination_prefix, source_storage))
+
+    def move_prefix(self, source_prefix, destination_prefix,
+                    source_storage=None):
+        """
+        Moves every blob whose name starts with source_prefix like
+        copy_prefix. Sources are only deleted once copied. Prefixes of the
+        same container may not be equal or contain one another.
+        """
+        if self._same_container(source_storage) and (
+                source_prefix.startswith(destination_prefix) or
+                destination_prefix.startswith(source_prefix)):
+            raise ValueError('Cannot move %r to %r within the same '
+                             'container' % (source_prefix,
+                                            destination_prefix))
+        return self._run_many(self.move, self._prefix_pairs(
+            source_prefix, destination_prefix, source_storage))
+
+    @instrumented('delete')
     def delete(self, name):
         try:
             self.service.delete_blob(container_name=self.container,
                                      blob_name=name)
         except WindowsAzureMissingResourceError:
             pass
+        self._invalidate_properties(name)
 
+    @instrumented('exists')
     def exists(self, name):
         try:
             self._get_properties(name)
@@ -89,61 +746,474 @@ class AzureStorage(Storage):
         else:
             return True
 
-    def get_available_name(self, name):
+    def get_available_name(self, name, max_length=None):
         if self.allow_override:
             return self._clean_name(name)
-        return super(AzureStorage, self).get_available_name(name)
+        if max_length is None:  # Django < 1.8 has no max_length
+            return super(AzureStorage, self).get_available_name(name)
+        return super(AzureStorage, self).get_available_name(
+            name, max_length=max_length)
 
+    def _list_pages(self, prefix=None, delimiter=None, include=None):
+        """
+        Yields the pages of a blob listing, following the continuation
+        markers, and fills the properties cache along the way
+        """
+        marker = None
+        while True:
+            page = self.service.list_blobs(container_name=self.container,
+                                           prefix=prefix, marker=marker,
+                                           delimiter=delimiter,
+                                           include=include)
+            self._cache_listed_blobs(page.blobs)
+            yield page
+            marker = page.next_marker
+            if not marker:
+                break
+
+    def iter_blobs(self, prefix=None, include=None):
+        """
+        Lazily yields every blob (name and properties) whose name starts
+        with prefix, one listing page at a time. include='metadata' lists
+        their metadata too.
+        """
+        for page in self._list_pages(prefix=prefix or None, include=include):
+            for blob in page.blobs:
+                yield blob
+
+    @instrumented('listdir')
     def listdir(self, path, flat=False):
-        blobs = self.service.list_blobs(container_name=self.container,
-                                        prefix=path if path != '' else None)
+        if path and not path.endswith('/'):
+            path = u'%s/' % path
         if flat:
-            if path and not path.endswith('/'):
-                path = u'%s/' % path
-            return ([], [blob.name[len(path):] for blob in blobs])
-        else:
-            dirs, files = set(), []
-            base_parts = path.split("/") if path and path != '' else []
-            for blob in blobs:
-                parts = blob.name.split("/")[len(base_parts):]
-                if len(parts) == 1:
-                    files.append(parts[-1])
-                elif len(parts) > 1:
-                    dirs.add(parts[0])
-        return (list(dirs), files)
+            return ([], [blob.name[len(path):]
+                         for blob in self.iter_blobs(path)])
+        dirs, files = [], []
+        for page in self._list_pages(prefix=path or None, delimiter='/'):
+            dirs.extend(prefix.name[len(path):].rstrip('/')
+                        for prefix in page.prefixes)
+            files.extend(blob.name[len(path):] for blob in page.blobs)
+        return (dirs, files)
 
+    @instrumented('modified_time')
     def modified_time(self, name):
         return datetime.strptime(self._get_properties(name)['last-modified'],
                                  ls.TIMESTAMP_FORMAT)
 
     @property
     def service(self):
-        if self._service is None:
-            self._service = BlobService(account_name=self.account_name,
-                                        account_key=self.account_key,
-                                        protocol=self.protocol)
-        return self._service
+        return get_blob_service(account_name=self.account_name,
+                                account_key=self.account_key,
+                                protocol=self.protocol)
 
+    @instrumented('size')
     def size(self, name):
         return int(self._get_properties(name)['content-length'])
 
-    def url(self, name):
-        if self.cdn_host:
-            return u'{0}://{1}/{2}/{3}'.format(self.protocol, self.cdn_host,
-                                               self.container, quote(name.encode('utf8')))
-        else:
-            return self.service.make_blob_url(container_name=self.container,
-                                              blob_name=quote(name.encode('utf8')))
+    def _signed_url(self, name, expire, permission):
+        """
+        Returns a url carrying a Shared Access Signature, signed locally
+        with the account key
+        """
+        bucket = ls.AZURE_URL_EXPIRE_BUCKET
+        expiry = (int(time.time()) + expire) // bucket * bucket + bucket
+        key = (name, permission, expiry)
+        url = self._signed_urls.get(key)
+        if url is None:
+            policy = SharedAccessPolicy(AccessPolicy(
+                expiry=time.strftime(ls.SAS_TIMESTAMP_FORMAT,
+                                     time.gmtime(expiry)),
+                permission=permission))
+            signature = SharedAccessSignature(self.account_name,
+                                              self.account_key)
+            query = signature._convert_query_string(
+                signature.generate_signed_query_string(
+                    u'%s/%s' % (self.container, name), 'b', policy))
+            url = u'%s%s?%s' % (self._url_base(use_cdn=False),
+                                self._quote(name), query.rstrip('&'))
+            self._signed_urls.set(key, url)
+        return url
+
+    def _url_base(self, use_cdn=True):
+        """
+        Returns the url of the container, ending with a slash, on the CDN
+        host if there is one (and use_cdn is set) or on the blob service.
+        Urls are computed once per configuration.
+        """
+        cdn_host = self.cdn_host if use_cdn else None
+        key = (self.protocol, cdn_host, self.account_name, self.container)
+        base = self._url_bases.get(key)
+        if base is None:
+            if cdn_host:
+                base = u'{0}://{1}/{2}/'.format(self.protocol, cdn_host,
+                                                self.container)
+            elif self.account_name:
+                base = u'{0}://{1}{2}/{3}/'.format(
+                    self.protocol, self.account_name, BLOB_SERVICE_HOST_BASE,
+                    self.container)
+            else:
+                # the development account, which only the client knows of
+                base = self.service.make_blob_url(
+                    container_name=self.container, blob_name=u'')
+            self._url_bases[key] = base
+        return base
+
+    def _quote(self, name):
+        quoted = self._quoted_names.get(name)
+        if quoted is None:
+            quoted = quote(name.encode('utf8'))
+            self._quoted_names.set(name, quoted)
+        return quoted
+
+    def url(self, name, expire=None, permission='r'):
+        """
+        Returns the url of the blob. If expire (or AZURE_URL_EXPIRE) is set,
+        the url grants the given permissions for that many seconds.
+        With url_versioning, urls of blobs whose properties are cached end
+        with their ETag, so that they change with the content.
+        """
+        if expire is None:
+            expire = self.url_expire
+        if expire:
+            return self._signed_url(name, expire, permission)
+        url = self._url_base() + self._quote(name)
+        if self.url_versioning and self.properties_cache is not None:
+            properties = self.properties_cache.get(self.container, name)
+            if properties is not None and properties.get('etag'):
+                url = u'%s?v=%s' % (url, properties['etag'].strip('"'))
+        return url
 
 
 class StaticFilesAzureStorage(AzureStorage):
     """
     Default Azure STATICFILES_STORAGE. It's generally expensive
     since it asks the cloud for every operation.
+
+    With AZURE_STATIC_FAST_COLLECT (or fast_collect=True) it is tuned for
+    collectstatic instead: the container is listed once and exists, size
+    and modified_time are answered from that listing, files whose MD5
+    matches it are not uploaded again, and the others are uploaded
+    AZURE_STATIC_UPLOAD_CONCURRENCY at a time. Deletes are deferred, and
+    dropped if the file is saved again. Everything is flushed in
+    post_process, at the end of collectstatic.
     """
     def __init__(self, *args, **kwargs):
+        self.fast_collect = kwargs.pop('fast_collect',
+                                       ls.AZURE_STATIC_FAST_COLLECT)
         super(StaticFilesAzureStorage, self).__init__(*args, **kwargs)
         self.container = ls.AZURE_STATIC_FILES_CONTAINER
+        self._listing = None
+        self._pending_deletes = {}
+        self._uploads = []
+        self._upload_pool = None
+        self._collect_lock = threading.Lock()
+
+    @property
+    def listing(self):
+        """
+        The size, Last-Modified and Content-MD5 of every blob, by name.
+        The MD5 of compressed blobs is the one of their source.
+        """
+        with self._collect_lock:
+            if self._listing is None:
+                self._listing = dict(
+                    (blob.name, (int(blob.properties.content_length),
+                                 blob.properties.last_modified,
+                                 source_md5(blob)))
+                    for blob in self.iter_blobs(include='metadata'))
+            return self._listing
+
+    def _upload(self, name, data):
+        super(StaticFilesAzureStorage, self)._save(name, ContentFile(data))
+
+    def _save(self, name, content):
+        if not self.fast_collect:
+            return super(StaticFilesAzureStorage, self)._save(name, content)
+        data = b''.join(force_bytes(chunk) for chunk in content.chunks())
+        md5 = md5_digest(hashlib.md5(data))
+        listing = self.listing
+        with self._collect_lock:
+            entry = self._pending_deletes.pop(name, None) or \
+                listing.get(name)
+            # sizes of compressed blobs differ from the source, MD5s don't
+            if entry is not None and entry[2] == md5:
+                listing[name] = entry
+                return name
+            listing[name] = (len(data), time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime()), md5)
+            if self._upload_pool is None:
+                self._upload_pool = BoundedPool(
+                    ls.AZURE_STATIC_UPLOAD_CONCURRENCY)
+                atexit.register(self.flush)
+        # blocks while the pool is busy, so few files are held in memory
+        upload = self._upload_pool.submit(self._upload, name, data)
+        with self._collect_lock:
+            self._uploads.append(upload)
+        return name
+
+    def delete(self, name):
+        if self.fast_collect:
+            listing = self.listing
+            with self._collect_lock:
+                if name in listing:
+                    self._pending_deletes[name] = listing.pop(name)
+                return
+        super(StaticFilesAzureStorage, self).delete(name)
+
+    def exists(self, name):
+        if self.fast_collect:
+            return name in self.listing
+        return super(StaticFilesAzureStorage, self).exists(name)
+
+    def size(self, name):
+        if self.fast_collect and name in self.listing:
+            return self.listing[name][0]
+        return super(StaticFilesAzureStorage, self).size(name)
+
+    def modified_time(self, name):
+        if self.fast_collect and name in self.listing:
+            return datetime(*parsedate(self.listing[name][1])[:6])
+        return super(StaticFilesAzureStorage, self).modified_time(name)
+
+    def flush(self):
+        """
+        Waits for the queued uploads, then sends the deferred deletes.
+        Raises the first error met by an upload.
+        """
+        with self._collect_lock:
+            uploads, self._uploads = self._uploads, []
+            pool, self._upload_pool = self._upload_pool, None
+            deletes, self._pending_deletes = list(self._pending_deletes), {}
+        errors = []
+        for upload in uploads:
+            try:
+                upload.get()
+            except Exception as e:
+                errors.append(e)
+        if pool is not None:
+            pool.close()
+        delete = super(StaticFilesAzureStorage, self).delete
+        errors.extend(error for result, error in self._run_many(
+            delete, [(name,) for name in deletes]) if error is not None)
+        if errors:
+            raise errors[0]
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            self.flush()
+        return []
+
+
+class ManifestStaticFilesAzureStorage(StaticFilesAzureStorage):
+    """
+    A STATICFILES_STORAGE that uploads files under content-hashed names
+    with far-future Cache-Control headers, and keeps a JSON manifest of
+    each file's hash, hashed name and upload time in the container.
+
+    The manifest is fetched once, so exists, modified_time and url don't
+    ask the cloud and collectstatic skips unchanged files. It is written
+    back in post_process. Urls inside css files are not rewritten.
+    """
+    manifest_name = ls.AZURE_STATIC_MANIFEST_NAME
+    cache_control = ls.AZURE_STATIC_CACHE_CONTROL
+
+    def __init__(self, *args, **kwargs):
+        super(ManifestStaticFilesAzureStorage, self).__init__(*args, **kwargs)
+        self._manifest = None
+        self._deleted = {}
+        self._manifest_lock = threading.Lock()
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                data = self.service.get_blob(container_name=self.container,
+                                             blob_name=self.manifest_name)
+            except WindowsAzureMissingResourceError:
+                self._manifest = {}
+            else:
+                self._manifest = json.loads(data.decode('utf8'))['paths']
+        return self._manifest
+
+    def save_manifest(self):
+        data = json.dumps({'version': '1.0', 'paths': self.manifest})
+        self.service.put_blob(container_name=self.container,
+                              blob_name=self.manifest_name,
+                              blob=data.encode('utf8'),
+                              x_ms_blob_type='BlockBlob',
+                              x_ms_blob_content_type='application/json',
+                              x_ms_blob_cache_control='no-cache')
+
+    def hashed_name(self, name, file_hash):
+        root, ext = os.path.splitext(name)
+        return u'%s.%s%s' % (root, file_hash[:12], ext)
+
+    def _save(self, name, content):
+        md5 = hashlib.md5()
+        for chunk in content.chunks():
+            md5.update(force_bytes(chunk))
+        content.seek(0)
+        file_hash = md5.hexdigest()
+        entry = self.manifest.get(name) or self._deleted.get(name)
+        if entry is None or entry['hash'] != file_hash:
+            hashed_name = self.hashed_name(name, file_hash)
+            super(ManifestStaticFilesAzureStorage, self)._save(hashed_name,
+                                                               content)
+            entry = {'hash': file_hash, 'name': hashed_name}
+        entry['modified'] = time.time()
+        with self._manifest_lock:
+            self.manifest[name] = entry
+            self._deleted.pop(name, None)
+        return name
+
+    def delete(self, name):
+        """
+        Drops the name from the manifest. Hashed blobs are immutable and
+        may still be referenced by cached pages, so they are kept.
+        """
+        with self._manifest_lock:
+            if name in self.manifest:
+                self._deleted[name] = self.manifest.pop(name)
+                return
+        super(ManifestStaticFilesAzureStorage, self).delete(name)
+
+    def stored_name(self, name):
+        """
+        Returns the hashed name the file is stored under, or the name
+        itself if it is not in the manifest
+        """
+        entry = self.manifest.get(name)
+        return name if entry is None else entry['name']
+
+    def exists(self, name):
+        return name in self.manifest
+
+    def modified_time(self, name):
+        return datetime.fromtimestamp(self.manifest[name]['modified'])
+
+    def size(self, name):
+        return super(ManifestStaticFilesAzureStorage, self).size(
+            self.stored_name(name))
+
+    def _open(self, name, mode='rb'):
+        return super(ManifestStaticFilesAzureStorage, self)._open(
+            self.stored_name(name), mode)
+
+    def url(self, name, *args, **kwargs):
+        return super(ManifestStaticFilesAzureStorage, self).url(
+            self.stored_name(name), *args, **kwargs)
+
+    def post_process(self, paths, dry_run=False, **options):
+        super(ManifestStaticFilesAzureStorage, self).post_process(
+            paths, dry_run, **options)
+        if not dry_run:
+            self.save_manifest()
+        return []
+
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2
+    pass
+
+else:
+    class AsyncChunks(object):
+        """
+        Asynchronous iterator over the chunks of a file, each one read on
+        the thread pool of the storage
+        """
+        def __init__(self, chunks, storage):
+            self._chunks = chunks
+            self._storage = storage
+
+        def _next(self):
+            try:
+                return next(self._chunks)
+            except StopIteration:
+                raise StopAsyncIteration
+
+        def __aiter__(self):
+            return self
+
+        def __anext__(self):
+            return self._storage._run(self._next)
+
+    class AsyncAzureFile(object):
+        """
+        Wraps a file opened by AsyncAzureStorage so that reading it, which
+        makes requests, runs on the thread pool instead of the event loop.
+        read and seek are awaitable; iterate chunks with ``async for``.
+        """
+        def __init__(self, file, storage):
+            self.file = file
+            self.name = file.name
+            self._storage = storage
+
+        def read(self, num_bytes=None):
+            return self._storage._run(self.file.read, num_bytes)
+
+        def seek(self, offset, whence=os.SEEK_SET):
+            return self._storage._run(self.file.seek, offset, whence)
+
+        def tell(self):
+            return self.file.tell()
+
+        def chunks(self, chunk_size=None):
+            return AsyncChunks(self.file.chunks(chunk_size), self._storage)
+
+        def close(self):
+            self.file.close()
+
+    class AsyncAzureStorage(AzureStorage):
+        """
+        An AzureStorage with awaitable counterparts of its operations, for
+        use from ASGI views. The Azure client is blocking, so every call
+        runs on a bounded thread pool instead of the event loop; naming,
+        compression and content types follow the synchronous methods.
+        """
+        def __init__(self, *args, **kwargs):
+            max_workers = kwargs.pop('max_workers',
+                                     ls.AZURE_ASYNC_CONCURRENCY)
+            super(AsyncAzureStorage, self).__init__(*args, **kwargs)
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def _run(self, func, *args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return loop.run_in_executor(self.executor,
+                                        functools.partial(func, *args,
+                                                          **kwargs))
+
+        def asave(self, name, content, **kwargs):
+            return self._run(self.save, name, content, **kwargs)
+
+        def _open_async(self, name, mode):
+            return AsyncAzureFile(self.open(name, mode), self)
+
+        def aopen(self, name, mode='rb'):
+            """
+            Resolves to an AsyncAzureFile, whose reads are awaitable too
+            """
+            return self._run(self._open_async, name, mode)
+
+        def aexists(self, name):
+            return self._run(self.exists, name)
+
+        def adelete(self, name):
+            return self._run(self.delete, name)
+
+        def alistdir(self, path, flat=False):
+            return self._run(self.listdir, path, flat)
+
+        def asize(self, name):
+            return self._run(self.size, name)
+
+        def aexists_many(self, names):
+            """
+            Checks all names concurrently. Resolves to a list of booleans
+            in the order of names.
+            """
+            return asyncio.gather(*[self.aexists(name) for name in names])
 
 
 try:
@@ -160,6 +1230,10 @@ else:
 
         STATICFILES_STORAGE = 'django_azure.storage.CachedAzureStorage'
         COMPRESS_STORAGE = 'django_azure.storage.CachedAzureStorage'
+
+        With AZURE_WRITE_BEHIND, saving returns as soon as the local copy
+        is written and the upload happens in background threads. Until it
+        is confirmed, url returns the local url.
         """
         def __init__(self, *args, **kwargs):
             super(CachedAzureStorage, self).__init__(*args, **kwargs)
@@ -167,9 +1241,18 @@ else:
                 container=ls.AZURE_STATIC_FILES_CONTAINER,
                 allow_override=True
             )
+            self.upload_queue = None
+            if ls.AZURE_WRITE_BEHIND:
+                self.upload_queue = UploadQueue(
+                    ls.AZURE_WRITE_BEHIND_QUEUE_DIR or
+                    os.path.join(self.location, '.azure-queue'),
+                    self._upload, workers=ls.AZURE_WRITE_BEHIND_WORKERS,
+                    retries=ls.AZURE_WRITE_BEHIND_RETRIES)
+                # resume the uploads left pending by earlier processes
+                self.upload_queue.start()
 
-        def get_available_name(self, name):
-            name = self.remote_storage._clean_name(name)
+        def get_available_name(self, name, max_length=None):
+            name = self.remote_storage.get_available_name(name, max_length)
             if self.exists(name):
                 self.delete(name)
             return name
@@ -178,20 +1261,38 @@ else:
             """
             Save in both storages
             """
+            if self.upload_queue is not None:
+                # store locally and leave the upload to the queue
+                name = super(CachedAzureStorage, self)._save(name, content)
+                self.upload_queue.put(name)
+                return name
             # store remotely
             self.remote_storage._save(name, content)
             # ... and then locally
             return super(CachedAzureStorage, self)._save(name, content)
 
+        def _upload(self, name):
+            """
+            Uploads the local copy of a file, for the upload queue
+            """
+            with self.open(name) as content:
+                self.remote_storage._save(name, content)
+
         def delete(self, name):
             """
             Delete in both storages
             """
             super(CachedAzureStorage, self).delete(name)
+            if self.upload_queue is not None:
+                self.upload_queue.discard(name)
             self.remote_storage.delete(name)
 
         def url(self, name):
             """
-            Return the Azure url
+            Return the Azure url, or the local one while the upload is
+            still pending
             """
+            if self.upload_queue is not None and \
+                    self.upload_queue.pending(name):
+                return super(CachedAzureStorage, self).url(name)
             return self.remote_storage.url(name)
@@ -1,7 +1,36 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from unittest import skipIf
+from azure import WindowsAzureMissingResourceError
+from azure.http import HTTPError, HTTPRequest
 from django.core.files.base import ContentFile
 from django.test import SimpleTestCase
 from . import settings as ls
-from .storage import AzureStorage
+from . import memory
+from .instrumentation import storage_operation
+from .memory import MemoryBlobService
+from .retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from .storage import (AzureStorage, AzureUploadedFile,
+                      ManifestStaticFilesAzureStorage,
+                      StaticFilesAzureStorage)
+try:
+    import asyncio
+    from .storage import AsyncAzureStorage
+except ImportError:  # Python 2
+    AsyncAzureStorage = None
+try:
+    from . import dbbackup_storage
+except (ImportError, NameError):  # django-dbbackup is not installed
+    dbbackup_storage = None
+from .tiers import BlobArchivedError, get_blob_tier, set_blob_tier
+from .uploadhandler import AzureUploadHandler
+from .writebehind import UploadQueue
 
 
 class AzureStorageTestCase(SimpleTestCase):
@@ -46,6 +75,10 @@ class AzureStorageTestCase(SimpleTestCase):
                                      u'dummy-2/blob-4',
                                      u'dummy-3/blob-5'])
 
+        self.assertListEqual(
+            [blob.name for blob in self.storage.iter_blobs(u'dummy-2/')],
+            [u'dummy-2/blob-3', u'dummy-2/blob-4'])
+
         # clean up dummy blobs
         self.storage.delete(u'dummy-1/blob-2')
         self.storage.delete(u'dummy-1/dummy-2/blob-1')
@@ -81,6 +114,92 @@ class AzureStorageTestCase(SimpleTestCase):
         self.storage.delete(u'dummy-blob')
         self.assertFalse(self.storage.exists(u'dummy-blob'))
 
+    def test_save_blocks(self):
+        """
+        Tests that large content is uploaded as a list of blocks
+        """
+        self.storage.single_put_threshold = 10
+        self.storage.block_size = 4
+        self.storage.save(u'dummy-blob', ContentFile('dummy block content'))
+        self.assertEqual(self.storage.size(u'dummy-blob'), 19)
+        blob = self.storage.open(u'dummy-blob')
+        self.assertEqual(blob.read(), u'dummy block content')
+        blob.close()
+        self.storage.delete(u'dummy-blob')
+
+    def test_open_ranges(self):
+        """
+        Tests that the opened blob is read lazily in ranges
+        """
+        self.storage.save(u'dummy-blob', ContentFile('dummy range content'))
+        blob = self.storage.open(u'dummy-blob')
+        blob.buffer_size = 4
+        self.assertEqual(blob.read(5), 'dummy')
+        blob.seek(-7, 2)
+        self.assertEqual(blob.read(), 'content')
+        self.assertEqual(blob.size, 19)
+        self.assertEqual(''.join(blob.chunks(3)), 'dummy range content')
+        blob.close()
+        self.storage.delete(u'dummy-blob')
+
+    def test_properties_cache(self):
+        """
+        Tests that blob properties are served from the cache
+        """
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               properties_cache='local')
+        storage.save(u'dummy-blob', ContentFile('dummy content'))
+        hits = storage.properties_cache.hits
+        storage.listdir(u'')
+        self.assertEqual(storage.size(u'dummy-blob'), 13)
+        self.assertTrue(storage.exists(u'dummy-blob'))
+        self.assertEqual(storage.properties_cache.hits, hits + 2)
+        storage.delete(u'dummy-blob')
+        self.assertFalse(storage.exists(u'dummy-blob'))
+
+    def test_save_gzipped(self):
+        """
+        Tests that compressible content is stored gzipped
+        """
+        self.storage.gzipped = True
+        self.storage.block_size = 64
+        self.storage.save(u'dummy.css', ContentFile('body {}\n' * 100))
+        self.assertEqual(
+            self.storage._get_properties(u'dummy.css')['content-encoding'],
+            'gzip')
+        blob = self.storage.open(u'dummy.css')
+        self.assertEqual(zlib.decompress(blob.read(), 16 + zlib.MAX_WBITS),
+                         b'body {}\n' * 100)
+        blob.close()
+        self.storage.delete(u'dummy.css')
+
+    def test_bulk_operations(self):
+        """
+        Tests the AzureStorage save_many, exists_many and delete_many methods
+        """
+        names = [u'dummy-1/blob-1', u'dummy-1/blob-2']
+        results = self.storage.save_many(
+            [(name, ContentFile('1')) for name in names])
+        self.assertListEqual(results, [(name, None) for name in names])
+        self.assertListEqual(
+            self.storage.exists_many(names + [u'dummy-1/blob-3']),
+            [(True, None), (True, None), (False, None)])
+        self.storage.save(u'dummy-1/dummy-2/blob-4', ContentFile('1'))
+        self.assertListEqual(
+            self.storage.exists_many([u'dummy-1/blob-1',
+                                      u'dummy-1/dummy-2/blob-4',
+                                      u'dummy-1/blob-4', u'dummy-blob']),
+            [(True, None), (True, None), (False, None), (False, None)])
+        self.storage.delete(u'dummy-1/dummy-2/blob-4')
+        results = AzureStorage(container=u'dummy-missing').exists_many(names)
+        self.assertListEqual([result for result, error in results],
+                             [None, None])
+        self.assertIsInstance(results[0][1], WindowsAzureMissingResourceError)
+        self.assertListEqual(self.storage.delete_many(names),
+                             [(None, None), (None, None)])
+        self.assertListEqual(self.storage.exists_many(names),
+                             [(False, None), (False, None)])
+
     def test_url(self):
         """
         Tests the AzureStorage url method
@@ -94,3 +213,497 @@ class AzureStorageTestCase(SimpleTestCase):
         self.assertEqual(self.storage.url(u'dummy-blob'),
                          '%s://dummy.com/%s/dummy-blob' % 
                          (self.storage.protocol, self.storage.container))
+
+    def test_signed_url(self):
+        """
+        Tests that urls with an expiry carry a Shared Access Signature
+        """
+        url = self.storage.url(u'dummy-blob', expire=60)
+        self.assertTrue(url.startswith(
+            '%s://%s.blob.core.windows.net/%s/dummy-blob?se=' %
+            (self.storage.protocol, self.storage.account_name,
+             self.storage.container)))
+        self.assertIn('&sp=r&sr=b&', url)
+        self.assertIn('&sig=', url)
+        self.assertEqual(self.storage.url(u'dummy-blob', expire=60), url)
+
+    def test_storage_operation_signal(self):
+        """
+        Tests that storage operations are reported through the
+        storage_operation signal
+        """
+        operations = []
+
+        def receiver(sender, operation, name, error, **kwargs):
+            operations.append((operation, name, error))
+        storage_operation.connect(receiver)
+        try:
+            self.storage.exists(u'dummy-blob')
+        finally:
+            storage_operation.disconnect(receiver)
+        self.assertListEqual(operations, [(u'exists', u'dummy-blob', None)])
+
+    def test_disk_cache(self):
+        """
+        Tests that opened blobs are served from the disk cache until they
+        change
+        """
+        directory = tempfile.mkdtemp()
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               disk_cache_dir=directory)
+        try:
+            storage.save(u'dummy-blob', ContentFile('dummy content'))
+            storage.open(u'dummy-blob').close()
+            self.assertEqual(len(os.listdir(directory)), 1)
+            blob = storage.open(u'dummy-blob')
+            self.assertEqual(blob.read(), b'dummy content')
+            blob.close()
+            storage.save(u'dummy-blob', ContentFile('new content'))
+            self.assertListEqual(os.listdir(directory), [])
+            blob = storage.open(u'dummy-blob')
+            self.assertEqual(blob.read(), b'new content')
+            blob.close()
+        finally:
+            storage.delete(u'dummy-blob')
+            shutil.rmtree(directory)
+
+    def test_dedupe(self):
+        """
+        Tests that saving the content already stored does not upload it
+        again when dedupe is enabled
+        """
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               dedupe=True)
+        storage.save(u'dummy-blob', ContentFile('dummy content'))
+        etag = storage._get_properties(u'dummy-blob')['etag']
+        storage.save(u'dummy-blob', ContentFile('dummy content'))
+        self.assertEqual(storage._get_properties(u'dummy-blob')['etag'], etag)
+        storage.save(u'dummy-blob', ContentFile('other content'))
+        self.assertNotEqual(storage._get_properties(u'dummy-blob')['etag'],
+                            etag)
+        storage.delete(u'dummy-blob')
+
+    def test_copy_and_move(self):
+        """
+        Tests the AzureStorage copy, move and move_prefix methods
+        """
+        self.storage.save(u'dummy-1/blob-1', ContentFile('dummy content'))
+        self.assertEqual(self.storage.copy(u'dummy-1/blob-1', u'dummy-2'),
+                         u'dummy-2')
+        self.assertEqual(self.storage.size(u'dummy-2'), 13)
+        self.storage.move(u'dummy-2', u'dummy-1/blob-2')
+        self.assertFalse(self.storage.exists(u'dummy-2'))
+        self.assertListEqual(
+            self.storage.move_prefix(u'dummy-1/', u'dummy-3/'),
+            [(u'dummy-3/blob-1', None), (u'dummy-3/blob-2', None)])
+        self.assertTupleEqual(self.storage.listdir(u''), ([u'dummy-3'], []))
+        self.assertEqual(self.storage.move(u'dummy-3/blob-1',
+                                           u'dummy-3/blob-1'),
+                         u'dummy-3/blob-1')
+        self.assertTrue(self.storage.exists(u'dummy-3/blob-1'))
+        self.assertRaises(ValueError, self.storage.move_prefix,
+                          u'dummy-3/', u'dummy-3/')
+        self.assertRaises(ValueError, self.storage.move_prefix,
+                          u'dummy-3/', u'dummy-3/sub/')
+        self.assertTrue(self.storage.exists(u'dummy-3/blob-2'))
+        self.storage.delete_many([u'dummy-3/blob-1', u'dummy-3/blob-2'])
+
+    def test_url_versioning(self):
+        """
+        Tests that urls carry the ETag of blobs with cached properties
+        """
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               cdn_host=u'dummy.com',
+                               properties_cache='local',
+                               url_versioning=True)
+        self.assertEqual(storage.url(u'dummy blob'),
+                         '%s://dummy.com/%s/dummy%%20blob' %
+                         (storage.protocol, storage.container))
+        storage.properties_cache.set(storage.container, u'dummy blob',
+                                     {'etag': '"0x8D1"'})
+        self.assertEqual(storage.url(u'dummy blob'),
+                         '%s://dummy.com/%s/dummy%%20blob?v=0x8D1' %
+                         (storage.protocol, storage.container))
+        storage.properties_cache.delete(storage.container, u'dummy blob')
+
+    def test_static_fast_collect(self):
+        """
+        Tests that StaticFilesAzureStorage defers saves and deletes until
+        flushed when fast_collect is set
+        """
+        storage = StaticFilesAzureStorage(fast_collect=True)
+        storage.container = ls.AZURE_TEST_CONTAINER
+        self.assertFalse(storage.exists(u'dummy-blob'))
+        storage.save(u'dummy-blob', ContentFile('dummy content'))
+        self.assertTrue(storage.exists(u'dummy-blob'))
+        self.assertEqual(storage.size(u'dummy-blob'), 13)
+        storage.post_process([])
+        self.assertTrue(self.storage.exists(u'dummy-blob'))
+        storage.delete(u'dummy-blob')
+        self.assertFalse(storage.exists(u'dummy-blob'))
+        self.assertTrue(self.storage.exists(u'dummy-blob'))
+        storage.post_process([])
+        self.assertFalse(self.storage.exists(u'dummy-blob'))
+        # compressed files are compared with the MD5 of their source
+        for attempt in range(2):
+            storage = StaticFilesAzureStorage(fast_collect=True,
+                                              gzipped=True)
+            storage.container = ls.AZURE_TEST_CONTAINER
+            storage.save(u'dummy.css', ContentFile('body {}\n' * 100))
+            storage.post_process([])
+            if not attempt:
+                etag = self.storage._get_properties(u'dummy.css')['etag']
+        self.assertEqual(self.storage._get_properties(u'dummy.css')['etag'],
+                         etag)
+        self.storage.delete(u'dummy.css')
+
+    def test_access_tiers(self):
+        """
+        Tests that tier rules apply on save, and that reading an archived
+        blob requests its rehydration
+        """
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               tier_rules=((u'dummy-*', u'text/*', 'Cool'),))
+        storage.save(u'dummy-blob.txt', ContentFile('dummy content'))
+        self.assertEqual(get_blob_tier(storage.service, storage.container,
+                                       u'dummy-blob.txt')[0], 'Cool')
+        set_blob_tier(storage.service, storage.container, u'dummy-blob.txt',
+                      'Archive')
+        with storage.open(u'dummy-blob.txt') as blob:
+            self.assertRaises(BlobArchivedError, blob.read)
+        storage.delete(u'dummy-blob.txt')
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               tier_rules=((None, None, 'Cool'),))
+        storage.cache_control = 'max-age=60'
+        self.storage.save(u'dummy-source.txt', ContentFile('dummy content'))
+        for name in (storage.copy(u'dummy-source.txt', u'dummy-copy'),
+                     storage.save(u'dummy-upload', AzureUploadedFile(
+                         self.storage, u'dummy-source.txt', u'dummy.txt',
+                         'text/plain', 13, None))):
+            self.assertEqual(get_blob_tier(storage.service, storage.container,
+                                           name)[0], 'Cool')
+            properties = storage._get_properties(name)
+            self.assertEqual(properties['cache-control'], 'max-age=60')
+            self.assertEqual(properties['content-type'], 'text/plain')
+        self.storage.delete_many([u'dummy-copy', u'dummy-upload'])
+
+    def test_upload_handler(self):
+        """
+        Tests that AzureUploadHandler streams files to blocks, and that
+        saving the uploaded file moves the blob
+        """
+        storage = AzureStorage(container=ls.AZURE_TEST_CONTAINER,
+                               block_size=4)
+        handler = AzureUploadHandler(storage=storage)
+        handler.new_file('file', u'dummy.txt', 'text/plain', None)
+        for start, chunk in ((0, b'dummy'), (5, b' con'), (9, b'tent')):
+            handler.receive_data_chunk(chunk, start)
+        uploaded = handler.file_complete(13)
+        self.assertEqual(uploaded.name, u'dummy.txt')
+        self.assertEqual(uploaded.read(), b'dummy content')
+        temporary = uploaded.blob_name
+        self.assertEqual(self.storage.save(u'dummy-upload.txt', uploaded),
+                         u'dummy-upload.txt')
+        self.assertFalse(self.storage.exists(temporary))
+        with self.storage.open(u'dummy-upload.txt') as blob:
+            self.assertEqual(blob.read(), b'dummy content')
+        self.storage.delete(u'dummy-upload.txt')
+
+    def test_manifest_static_files(self):
+        """
+        Tests that ManifestStaticFilesAzureStorage stores files under
+        hashed names once, and keeps them in its manifest
+        """
+        storage = ManifestStaticFilesAzureStorage()
+        storage.container = ls.AZURE_TEST_CONTAINER
+        storage.save(u'dummy.css', ContentFile('body {}'))
+        entry = storage.manifest[u'dummy.css']
+        hashed_name = u'dummy.%s.css' % entry['hash'][:12]
+        self.assertEqual(entry['name'], hashed_name)
+        self.assertTrue(storage.url(u'dummy.css').endswith(hashed_name))
+        self.assertEqual(storage.size(u'dummy.css'), 7)
+        with storage.open(u'dummy.css') as blob:
+            self.assertEqual(blob.read(), b'body {}')
+        etag = self.storage._get_properties(hashed_name)['etag']
+        storage.save(u'dummy.css', ContentFile('body {}'))
+        self.assertEqual(self.storage._get_properties(hashed_name)['etag'],
+                         etag)
+        storage.delete(u'dummy.css')
+        self.assertFalse(storage.exists(u'dummy.css'))
+        self.assertTrue(self.storage.exists(hashed_name))
+        storage.save(u'dummy.css', ContentFile('body {}'))
+        storage.post_process([])
+        storage = ManifestStaticFilesAzureStorage()
+        storage.container = ls.AZURE_TEST_CONTAINER
+        self.assertEqual(storage.manifest[u'dummy.css']['name'], hashed_name)
+        self.assertTrue(storage.exists(u'dummy.css'))
+        self.storage.delete_many([hashed_name, storage.manifest_name])
+
+    @skipIf(AsyncAzureStorage is None, 'requires asyncio')
+    def test_async_storage(self):
+        """
+        Tests that AsyncAzureStorage reads and writes blobs off the event
+        loop thread
+        """
+        storage = AsyncAzureStorage(container=ls.AZURE_TEST_CONTAINER)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        threads = []
+
+        def receiver(sender, **kwargs):
+            threads.append(threading.current_thread())
+        storage_operation.connect(receiver)
+        try:
+            loop.run_until_complete(storage.asave(
+                u'dummy-blob', ContentFile(b'dummy content')))
+            self.assertTrue(loop.run_until_complete(
+                storage.aexists(u'dummy-blob')))
+            blob = loop.run_until_complete(storage.aopen(u'dummy-blob'))
+            self.assertEqual(loop.run_until_complete(blob.read()),
+                             b'dummy content')
+            chunks = blob.chunks(6)
+            data = []
+            while True:
+                try:
+                    data.append(loop.run_until_complete(chunks.__anext__()))
+                except StopAsyncIteration:
+                    break
+            self.assertListEqual(data, [b'dummy ', b'conten', b't'])
+            self.assertNotIn(threading.current_thread(), threads)
+            loop.run_until_complete(storage.adelete(u'dummy-blob'))
+        finally:
+            storage_operation.disconnect(receiver)
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+@skipIf(dbbackup_storage is None, 'requires django-dbbackup')
+class DbBackupStorageTestCase(SimpleTestCase):
+    def setUp(self):
+        class Storage(dbbackup_storage.Storage):
+            AZURE_ACCOUNT_NAME = ls.AZURE_ACCOUNT_NAME
+            AZURE_ACCOUNT_KEY = ls.AZURE_ACCOUNT_KEY
+            AZURE_CONTAINER = ls.AZURE_TEST_CONTAINER
+            AZURE_DIRECTORY = 'dummy-backups'
+            AZURE_BLOCK_SIZE = 4
+            AZURE_CONCURRENCY = 3
+        self.storage = Storage()
+
+    def tearDown(self):
+        self.storage.flush_index()
+        for name in self.storage.list_directory():
+            self.storage.delete_file(name)
+        self.storage.flush_index()
+
+    def test_delete_file(self):
+        """
+        Tests that backups are deleted in background threads and leave the
+        index in a single update, even when their blob is already gone
+        """
+        for name in ('dummy-1.dump', 'dummy-2.dump', 'dummy-3.dump'):
+            self.storage.write_file(ContentFile(b'dummy dump', name=name))
+        self.storage.service.delete_blob(self.storage.AZURE_CONTAINER,
+                                         'dummy-backups/dummy-1.dump')
+        threads = []
+        delete_blob = self.storage._delete_blob
+
+        def recording_delete_blob(filepath):
+            threads.append(threading.current_thread())
+            delete_blob(filepath)
+        self.storage._delete_blob = recording_delete_blob
+        self.storage.delete_file('dummy-1.dump')
+        self.storage.delete_file('dummy-2.dump')
+        self.assertEqual(len(self.storage._load_index()), 3)
+        self.assertListEqual(self.storage.list_directory(), ['dummy-3.dump'])
+        self.assertListEqual(list(self.storage._load_index()),
+                             ['dummy-3.dump'])
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_index_lease(self):
+        """
+        Tests that the index is not written while another process holds
+        its lease
+        """
+        self.storage.write_file(ContentFile(b'dummy dump',
+                                            name='dummy-1.dump'))
+        lease_id = self.storage._lease_index()
+        self.storage.delete_file('dummy-1.dump')
+        self.assertRaises(Exception, self.storage._save_index, {})
+        self.storage.service.lease_blob(self.storage.AZURE_CONTAINER,
+                                        self.storage.index_path, 'release',
+                                        x_ms_lease_id=lease_id)
+        self.assertListEqual(self.storage.list_directory(), [])
+
+    def test_download_order(self):
+        """
+        Tests that ranges fetched concurrently are written in order, even
+        when they complete out of order
+        """
+        content = b'0123456789abcdefghijklmnopqrstuvwxyz'
+        self.storage.write_file(ContentFile(content, name='dummy-1.dump'))
+        get_range = self.storage._get_range
+
+        def slow_get_range(filepath, start, end):
+            time.sleep(0.005 * (3 - start // 4 % 3))
+            return get_range(filepath, start, end)
+        self.storage._get_range = slow_get_range
+        self.assertEqual(self.storage.read_file('dummy-1.dump').read(),
+                         content)
+
+    def test_stream_reads(self):
+        """
+        Tests that streamed reads serve dbrestore's size lookup, and that
+        compressed backups are not streamed
+        """
+        self.storage.AZURE_STREAM_READS = True
+        content = b'dummy database dump' * 10
+        self.storage.write_file(ContentFile(content, name='dummy-1.dump'))
+        backup = self.storage.read_file('dummy-1.dump')
+        self.assertIsInstance(backup, dbbackup_storage.PipeReader)
+        backup.seek(0, 2)
+        self.assertEqual(backup.tell(), len(content))
+        backup.seek(0)
+        self.assertEqual(backup.read(10), content[:10])
+        self.assertRaises(IOError, backup.seek, -20, 1)
+        backup.seek(-5, 1)
+        self.assertRaises(IOError, backup.read)
+        backup.seek(10)
+        self.assertEqual(backup.read(), content[10:])
+        backup.close()
+
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+            gzip_file.write(content)
+        self.storage.write_file(ContentFile(compressed.getvalue(),
+                                            name='dummy-2.dump.gz'))
+        backup = self.storage.read_file('dummy-2.dump.gz')
+        self.assertNotIsInstance(backup, dbbackup_storage.PipeReader)
+        self.assertEqual(gzip.GzipFile(fileobj=backup, mode='rb').read(),
+                         content)
+
+
+class MemoryBlobServiceTestCase(SimpleTestCase):
+    def setUp(self):
+        self.service = MemoryBlobService('dummy-account', 'dummy-key')
+
+    def tearDown(self):
+        memory.reset()
+
+    def test_blobs(self):
+        """
+        Tests that MemoryBlobService stores, reads and deletes blobs like
+        the service
+        """
+        self.service.put_blob('dummy', 'blob', b'dummy content', 'BlockBlob',
+                              x_ms_blob_content_type='text/plain')
+        properties = self.service.get_blob_properties('dummy', 'blob')
+        self.assertEqual(properties['Content-Length'], '13')
+        self.assertEqual(properties['content-type'], 'text/plain')
+        data = self.service.get_blob('dummy', 'blob', x_ms_range='bytes=6-')
+        self.assertEqual(data, b'content')
+        self.assertEqual(data.properties['content-range'], 'bytes 6-12/13')
+        self.service.delete_blob('dummy', 'blob')
+        self.assertRaises(WindowsAzureMissingResourceError,
+                          self.service.get_blob, 'dummy', 'blob')
+
+    def test_list_blobs(self):
+        """
+        Tests that MemoryBlobService lists blobs in pages, grouped by
+        delimiter
+        """
+        for name in ('a/1', 'a/2', 'b', 'c/d/3'):
+            self.service.put_blob('dummy', name, b'', 'BlockBlob')
+        page = self.service.list_blobs('dummy', delimiter='/', maxresults=2)
+        self.assertListEqual([prefix.name for prefix in page.prefixes],
+                             ['a/'])
+        self.assertListEqual([blob.name for blob in page], ['b'])
+        page = self.service.list_blobs('dummy', delimiter='/',
+                                       marker=page.next_marker)
+        self.assertListEqual([prefix.name for prefix in page.prefixes],
+                             ['c/'])
+        self.assertFalse(page.next_marker)
+
+
+class UploadQueueTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uploaded = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def wait(self, upload_queue, name):
+        deadline = time.time() + 5
+        while upload_queue.pending(name) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def write_marker(self, upload_queue, name, suffix=''):
+        with open(upload_queue._marker(name) + suffix, 'w') as marker:
+            marker.write('{"name": "%s", "token": "dummy"}' % name)
+
+    def test_resume(self):
+        """
+        Tests that names left pending by an earlier process are uploaded
+        once the queue is used, without new puts
+        """
+        upload_queue = UploadQueue(self.directory, self.uploaded.append)
+        self.write_marker(upload_queue, u'dummy-1')
+        self.wait(upload_queue, u'dummy-1')
+        self.assertListEqual(self.uploaded, [u'dummy-1'])
+        self.assertListEqual(os.listdir(self.directory), [])
+        upload_queue.put(u'dummy-2')
+        self.wait(upload_queue, u'dummy-2')
+        self.assertListEqual(self.uploaded, [u'dummy-1', u'dummy-2'])
+
+    def test_claims(self):
+        """
+        Tests that names claimed by a live process are left to it, and
+        those claimed by a dead one are uploaded again
+        """
+        upload_queue = UploadQueue(self.directory, self.uploaded.append)
+        self.write_marker(upload_queue, u'dummy-1',
+                          '.%d.dummy.claimed' % os.getppid())
+        self.write_marker(upload_queue, u'dummy-2',
+                          '.999999999.dummy.claimed')
+        upload_queue.start()
+        self.wait(upload_queue, u'dummy-2')
+        self.assertListEqual(self.uploaded, [u'dummy-2'])
+        self.assertListEqual(os.listdir(self.directory), [
+            os.path.basename(upload_queue._marker(u'dummy-1')) +
+            '.%d.dummy.claimed' % os.getppid()])
+        upload_queue.discard(u'dummy-1')
+        self.assertListEqual(os.listdir(self.directory), [])
+
+
+class RetryPolicyTestCase(SimpleTestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(CircuitBreaker(2, 60), retries=2,
+                                  backoff=0)
+        self.request = HTTPRequest()
+        self.request.method = 'GET'
+
+    def test_retry(self):
+        """
+        Tests that transient errors are retried and others are not
+        """
+        responses = [HTTPError(500, 'dummy', [], b''), 'dummy response']
+
+        def send(request):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        self.assertEqual(self.policy(self.request, send), 'dummy response')
+        responses = [HTTPError(404, 'dummy', [], b''), 'dummy response']
+        self.assertRaises(HTTPError, self.policy, self.request, send)
+
+    def test_circuit_breaker(self):
+        """
+        Tests that calls fail fast once the account is throttled
+        """
+        def send(request):
+            raise HTTPError(503, 'dummy', [], b'')
+        self.assertRaises(CircuitOpenError, self.policy, self.request, send)
+        self.assertRaises(CircuitOpenError, self.policy, self.request,
+                          lambda request: 'dummy response')
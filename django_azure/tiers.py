@@ -0,0 +1,116 @@
+from datetime import datetime
+from fnmatch import fnmatch
+from xml.etree import ElementTree
+from azure import WindowsAzureError, _update_request_uri_query_local_storage
+from azure.http import HTTPRequest
+from azure.storage import _sign_storage_blob_request, _update_storage_header
+
+
+HOT, COOL, ARCHIVE = 'Hot', 'Cool', 'Archive'
+TIERS = (HOT, COOL, ARCHIVE)
+
+# access tiers need a newer service version than the one of the SDK, so
+# these requests are built by hand like in the setazurecors command
+API_VERSION = '2018-11-09'
+
+
+class BlobArchivedError(WindowsAzureError):
+    """
+    Raised when reading an archived blob. Its rehydration has been
+    requested; it can be read once it completes, which takes hours.
+    """
+    def __init__(self, message, name, archive_status=None):
+        super(BlobArchivedError, self).__init__(message)
+        self.name = name
+        self.archive_status = archive_status
+
+
+def tier_for(rules, name, content_type):
+    """
+    Returns the tier of the first (name pattern, content type pattern,
+    tier) rule matching the blob, or None. Patterns are shell-style and
+    None matches anything.
+    """
+    for name_pattern, content_type_pattern, tier in rules:
+        if (name_pattern is None or fnmatch(name, name_pattern)) and \
+                (content_type_pattern is None or
+                 fnmatch(content_type or '', content_type_pattern)):
+            return tier
+    return None
+
+
+def _perform(service, method, path, query=(), headers=()):
+    request = HTTPRequest()
+    request.method = method
+    request.host = service._get_host()
+    request.path = path
+    request.query = list(query)
+    request.headers = list(headers)
+    request.body = b''
+    request.path, request.query = _update_request_uri_query_local_storage(
+        request, service.use_local_storage)
+    request = _update_storage_header(request)
+    request.headers = [header for header in request.headers
+                       if header[0] != 'x-ms-version']
+    request.headers.append(('x-ms-version', API_VERSION))
+    request.headers.append(('x-ms-date', datetime.utcnow().strftime(
+        '%a, %d %b %Y %H:%M:%S GMT')))
+    # since 2015-02-21, a zero Content-Length is signed as an empty string
+    headers = request.headers
+    request.headers = [header for header in headers
+                       if header != ('Content-Length', '0')]
+    authorization = _sign_storage_blob_request(
+        request, service.account_name, service.account_key)
+    request.headers = headers + [('Authorization', authorization)]
+    return service._perform_request(request)
+
+
+def set_blob_tier(service, container_name, blob_name, tier):
+    """
+    Moves a block blob to the given tier. Moving an archived blob out of
+    the Archive tier starts its rehydration.
+    """
+    if hasattr(service, 'set_blob_tier'):
+        return service.set_blob_tier(container_name, blob_name, tier)
+    _perform(service, 'PUT', '/%s/%s' % (container_name, blob_name),
+             [('comp', 'tier')], [('x-ms-access-tier', tier)])
+
+
+def get_blob_tier(service, container_name, blob_name):
+    """
+    Returns the tier of a blob and its archive status, which tells about
+    a pending rehydration (e.g. 'rehydrate-pending-to-hot') or is None
+    """
+    if hasattr(service, 'get_blob_tier'):
+        return service.get_blob_tier(container_name, blob_name)
+    response = _perform(service, 'HEAD', '/%s/%s' % (container_name,
+                                                      blob_name))
+    headers = dict((name.lower(), value) for name, value in response.headers)
+    return (headers.get('x-ms-access-tier'),
+            headers.get('x-ms-archive-status'))
+
+
+def iter_blob_tiers(service, container_name, prefix=None):
+    """
+    Lazily yields the name, Last-Modified, tier and archive status of
+    every blob whose name starts with prefix, one listing page at a time
+    """
+    if hasattr(service, 'iter_blob_tiers'):
+        for blob in service.iter_blob_tiers(container_name, prefix):
+            yield blob
+        return
+    marker = None
+    while True:
+        response = _perform(service, 'GET', '/%s' % container_name, [
+            ('restype', 'container'), ('comp', 'list'), ('prefix', prefix),
+            ('marker', marker), ('maxresults', '5000')])
+        root = ElementTree.fromstring(response.body)
+        for blob in root.iter('Blob'):
+            properties = blob.find('Properties')
+            yield (blob.findtext('Name'),
+                   properties.findtext('Last-Modified'),
+                   properties.findtext('AccessTier'),
+                   properties.findtext('ArchiveStatus'))
+        marker = root.findtext('NextMarker')
+        if not marker:
+            break
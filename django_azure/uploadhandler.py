@@ -0,0 +1,65 @@
+import uuid
+from django.core.files.uploadhandler import FileUploadHandler
+from . import settings as ls
+from .storage import AzureStorage, AzureUploadedFile
+from .utils import BlockUploader
+
+
+class AzureUploadHandler(FileUploadHandler):
+    """
+    Streams uploaded files to the blob service while the request body is
+    read, one block at a time, instead of buffering them in memory or in a
+    temporary file. Add it first to FILE_UPLOAD_HANDLERS.
+
+    Files are stored under AZURE_UPLOAD_PREFIX in AZURE_UPLOAD_CONTAINER
+    and returned as AzureUploadedFile; saving them to a FileField backed by
+    an AzureStorage of the same account moves the blob without uploading
+    it again. Temporary blobs of files that are never saved are left
+    behind, expire them with a lifecycle rule on the prefix.
+    """
+    def __init__(self, request=None, storage=None):
+        super(AzureUploadHandler, self).__init__(request)
+        self.storage = storage or AzureStorage(
+            container=ls.AZURE_UPLOAD_CONTAINER)
+        # the parser reads the body in chunks of the smallest chunk_size
+        self.chunk_size = self.storage.block_size
+        self.uploader = None
+
+    def new_file(self, *args, **kwargs):
+        super(AzureUploadHandler, self).new_file(*args, **kwargs)
+        self.blob_name = u'%s%s/%s' % (ls.AZURE_UPLOAD_PREFIX,
+                                       uuid.uuid4().hex, self.file_name)
+        self.uploader = BlockUploader(lambda: self.storage.service,
+                                      self.storage.container, self.blob_name,
+                                      self.storage.upload_concurrency)
+        self.buffer = []
+        self.buffered = 0
+
+    def _put_blocks(self):
+        data = b''.join(self.buffer)
+        size = self.storage.block_size
+        end = len(data) - len(data) % size
+        for start in range(0, end, size):
+            self.uploader.put(data[start:start + size])
+        self.buffer, self.buffered = [data[end:]], len(data) - end
+
+    def receive_data_chunk(self, raw_data, start):
+        self.buffer.append(raw_data)
+        self.buffered += len(raw_data)
+        if self.buffered >= self.storage.block_size:
+            self._put_blocks()
+
+    def file_complete(self, file_size):
+        if self.buffered:
+            self.uploader.put(b''.join(self.buffer))
+        self.buffer = []
+        uploader, self.uploader = self.uploader, None
+        uploader.commit(x_ms_blob_content_type=self.content_type)
+        return AzureUploadedFile(self.storage, self.blob_name, self.file_name,
+                                 self.content_type, file_size, self.charset,
+                                 getattr(self, 'content_type_extra', None))
+
+    def upload_interrupted(self):
+        if self.uploader is not None:
+            self.uploader.abort()
+            self.uploader = None
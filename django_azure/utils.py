@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from django.utils.encoding import force_bytes
+
+
+class BoundedPool(object):
+    """
+    A thread pool that blocks the submitter once ``size`` tasks are in
+    flight, so a producer streaming payloads into it never holds more
+    than ``size`` of them at a time.
+    """
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self._pool = ThreadPool(self.size)
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._slots.release()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules ``func`` and returns its ``AsyncResult``. Blocks while
+        the pool is saturated.
+        """
+        self._slots.acquire()
+        try:
+            return self._pool.apply_async(self._run, (func, args, kwargs))
+        except:
+            self._slots.release()
+            raise
+
+    def map(self, func, iterable):
+        """
+        Like the builtin map, but runs concurrently. Re-raises the error
+        of the first failed task, in submission order.
+        """
+        results = [self.submit(func, item) for item in iterable]
+        return [result.get() for result in results]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def rechunk(chunks, size):
+    """
+    Regroups an iterable of byte strings into chunks of ``size`` bytes.
+    Only the last chunk may be shorter.
+    """
+    buf, buffered = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            data = b''.join(buf)
+            for start in range(0, len(data) - size + 1, size):
+                yield data[start:start + size]
+            rest = data[len(data) - len(data) % size:]
+            buf, buffered = [rest], len(rest)
+    if buffered:
+        yield b''.join(buf)
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that keeps the ``max_entries`` most recently
+    used items.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def md5_digest(md5):
+    """
+    Returns the digest of a hashlib md5 object as a Content-MD5 value
+    """
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+class BlockUploader(object):
+    """
+    Uploads the blocks of a block blob as they are given, ``concurrency``
+    at a time, until commit() is called. ``get_service`` is called in the
+    worker threads, since a BlobService must not be shared between
+    threads. Every block is sent with its Content-MD5, and the MD5 of the
+    whole blob is stored with the block list.
+    """
+    def __init__(self, get_service, container, name, concurrency):
+        self.get_service = get_service
+        self.container = container
+        self.name = name
+        self.block_ids = []
+        self.md5 = hashlib.md5()
+        self._results = []
+        self._pool = BoundedPool(concurrency)
+
+    def _put_block(self, block, block_id):
+        self.get_service().put_block(
+            container_name=self.container, blob_name=self.name, block=block,
+            blockid=block_id, content_md5=md5_digest(hashlib.md5(block)))
+
+    def put(self, block):
+        """
+        Queues a block, blocking while ``concurrency`` are in flight
+        """
+        block = force_bytes(block)
+        self.md5.update(block)
+        block_id = u'{0:08d}'.format(len(self.block_ids))
+        self.block_ids.append(block_id)
+        self._results.append(self._pool.submit(self._put_block, block,
+                                               block_id))
+
+    def commit(self, **headers):
+        """
+        Waits for the blocks, then commits them as the content of the blob
+        """
+        try:
+            for result in self._results:
+                result.get()
+        finally:
+            self._pool.close()
+        headers.setdefault('x_ms_blob_content_md5', md5_digest(self.md5))
+        self.get_service().put_block_list(
+            container_name=self.container, blob_name=self.name,
+            block_list=self.block_ids, **headers)
+
+    def abort(self):
+        """
+        Waits for the blocks in flight without committing them. The service
+        discards uncommitted blocks after a week.
+        """
+        self._pool.close()
+
+
+def put_blocks(get_service, container, name, chunks, concurrency, **headers):
+    """
+    Uploads an iterable of byte chunks as the blocks of a block blob with
+    a BlockUploader, and commits them
+    """
+    uploader = BlockUploader(get_service, container, name, concurrency)
+    try:
+        for chunk in chunks:
+            uploader.put(chunk)
+    except Exception:
+        uploader.abort()
+        raise
+    uploader.commit(**headers)
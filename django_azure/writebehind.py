@@ -0,0 +1,180 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+logger = logging.getLogger('django_azure')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class UploadQueue(object):
+    """
+    A durable queue of names waiting to be uploaded. Every pending name
+    has a marker file in ``directory`` until ``upload`` succeeds for it,
+    so uploads interrupted by a crash or a restart are picked up again by
+    the next process that starts the queue.
+
+    A worker claims a marker by renaming it to
+    ``<marker>.<pid>.<token>.claimed`` before uploading, so that processes
+    sharing the directory, like prefork workers, upload each name once.
+    Claims of processes that died are released when the queue starts.
+
+    pending() is called for every url, so it only looks at the names this
+    process queued or resumed, and at the marker of the name. A name
+    another process is uploading, its marker claimed, is not pending.
+    """
+    def __init__(self, directory, upload, workers=2, retries=5):
+        self.directory = directory
+        self.upload = upload
+        self.workers = workers
+        self.retries = retries
+        self._pid = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _marker(self, name):
+        return os.path.join(self.directory,
+                            hashlib.md5(name.encode('utf8')).hexdigest())
+
+    def _read_marker(self, path):
+        try:
+            with open(path) as marker:
+                return json.load(marker)
+        except (IOError, ValueError):
+            return None
+
+    def _claims(self, name):
+        prefix = os.path.basename(self._marker(name)) + '.'
+        return [os.path.join(self.directory, filename)
+                for filename in os.listdir(self.directory)
+                if filename.startswith(prefix) and
+                filename.endswith('.claimed')]
+
+    def start(self):
+        """
+        Starts the workers and enqueues the names left pending by earlier
+        processes, including those claimed by processes that died. Runs
+        again in forked children, whose threads are gone.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            # uploads of the parent are not this process's to wait for
+            self._pending = set()
+            for filename in os.listdir(self.directory):
+                parts = filename.split('.')
+                marker = os.path.join(self.directory, parts[0])
+                if filename.endswith('.claimed'):
+                    if _alive(int(parts[1])):
+                        continue
+                    try:
+                        os.rename(os.path.join(self.directory, filename),
+                                  marker)
+                    except OSError:
+                        continue
+                elif len(parts) > 1:
+                    # a marker being written
+                    continue
+                entry = self._read_marker(marker)
+                if entry is not None:
+                    self._pending.add(entry['name'])
+                    self._queue.put((entry['name'], 0))
+            for i in range(self.workers):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+            self._pid = os.getpid()
+
+    def put(self, name):
+        self.start()
+        marker = self._marker(name)
+        token = uuid.uuid4().hex
+        tmp = '%s.%s.tmp' % (marker, token)
+        with open(tmp, 'w') as f:
+            json.dump({'name': name, 'token': token}, f)
+        os.rename(tmp, marker)
+        # after the marker, see _work
+        with self._lock:
+            self._pending.add(name)
+        self._queue.put((name, 0))
+
+    def pending(self, name):
+        self.start()
+        return name in self._pending or os.path.exists(self._marker(name))
+
+    def discard(self, name):
+        for path in [self._marker(name)] + self._claims(name):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._pending.discard(name)
+
+    def _work(self):
+        while True:
+            name, attempt = self._queue.get()
+            marker = self._marker(name)
+            claimed = '%s.%d.%s.claimed' % (marker, os.getpid(),
+                                            uuid.uuid4().hex)
+            try:
+                os.rename(marker, claimed)
+            except OSError:
+                # uploaded, deleted or claimed by another worker meanwhile
+                self._done(name, marker)
+                continue
+            try:
+                self.upload(name)
+            except Exception:
+                try:
+                    os.rename(claimed, marker)
+                except OSError:
+                    # discarded meanwhile
+                    continue
+                if attempt < self.retries:
+                    retry = threading.Timer(2 ** attempt, self._queue.put,
+                                            ((name, attempt + 1),))
+                    retry.daemon = True
+                    retry.start()
+                else:
+                    logger.exception('Giving up uploading %s until the '
+                                     'next restart', name)
+                continue
+            # saving the name again while uploading wrote a new marker,
+            # which is queued on its own
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+            self._done(name, marker)
+
+    def _done(self, name, marker):
+        """
+        Forgets a name once uploaded, unless it was saved again meanwhile
+        """
+        with self._lock:
+            if not os.path.exists(marker):
+                self._pending.discard(name)